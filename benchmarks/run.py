@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+# Throughput and memory benchmark of esdedupe phases against a local
+# Elasticsearch stand-in (benchmarks/stub.py):
+#
+#   python -m benchmarks.run --docs 100000,1000000 --dupl 0.05,0.5 -j 1,4
+#
+# Comma separated options form a matrix of scenarios. Every scenario runs in
+# a fresh child process against a fresh stub, peak RSS of one scenario can't
+# leak into another. Within a scenario the peak is reset before every phase
+# (Linux), so each phase reports its own peak and growth over the RSS it
+# started with; elsewhere only the process-wide peak is available. Phases:
+#
+#   scan             scroll through the index and build the mapping
+#   build_index      mapping only, from synthetic hits generated in memory
+#   delete_iterator  produce delete actions from the mapping
+#   bulk             send delete actions (--delete-engine, -j)
+#
+# Results can be saved with --json and compared with a previous run using
+# --baseline, exit status is 1 when any phase got slower or used more memory
+# than --tolerance allows.
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import requests
+
+PHASES = ("scan", "build_index", "delete_iterator", "bulk")
+MATRIX = ("docs", "dupl", "threads", "delete_engine", "store", "scan_slices")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run", description="esdedupe benchmarks"
+    )
+    parser.add_argument("--docs", default="100000", help="Number of documents")
+    parser.add_argument("--dupl", default="0.1", help="Ratio of duplicates")
+    parser.add_argument("-j", "--threads", default="1", help="Bulk threads")
+    parser.add_argument(
+        "--delete-engine",
+        dest="delete_engine",
+        default="bulk",
+        help="bulk, adaptive, dbq",
+    )
+    parser.add_argument(
+        "--store", default="memory", help="memory (KeyStore), spill (SpillStore)"
+    )
+    parser.add_argument(
+        "--scan-slices", dest="scan_slices", default="1", help="Sliced scroll"
+    )
+    parser.add_argument("-b", "--batch", type=int, default=1000)
+    parser.add_argument("--flush", type=int, default=500)
+    parser.add_argument("--spill-memory", dest="spill_memory", default="64M")
+    parser.add_argument(
+        "--bulk-latency",
+        dest="bulk_latency",
+        type=float,
+        default=0.0,
+        help="Seconds the stub spends per deleted document",
+    )
+    parser.add_argument("--json", dest="json", help="Save results to JSON file")
+    parser.add_argument("--baseline", help="Compare with results saved by --json")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed relative slowdown/memory growth, default: 0.2",
+    )
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def scenarios(args):
+    values = []
+    for name in MATRIX:
+        kind = float if name == "dupl" else int
+        raw = str(getattr(args, name)).split(",")
+        if name in ("delete_engine", "store"):
+            values.append(raw)
+        else:
+            values.append([kind(v) for v in raw])
+    for combination in itertools.product(*values):
+        scenario = dict(zip(MATRIX, combination))
+        scenario.update(
+            batch=args.batch,
+            flush=args.flush,
+            spill_memory=args.spill_memory,
+            bulk_latency=args.bulk_latency,
+        )
+        yield scenario
+
+
+def scenario_name(scenario):
+    return " ".join(["{}={}".format(name, scenario[name]) for name in MATRIX])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_stub(scenario, port):
+    stub = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.stub",
+            "--port",
+            str(port),
+            "--docs",
+            str(scenario["docs"]),
+            "--dupl",
+            str(scenario["dupl"]),
+            "--bulk-latency",
+            str(scenario["bulk_latency"]),
+        ]
+    )
+    # generating keys takes a while for large indices
+    deadline = time.time() + 300
+    while time.time() < deadline:
+        try:
+            requests.get("http://127.0.0.1:{}/".format(port), timeout=1)
+            return stub
+        except requests.exceptions.ConnectionError:
+            if stub.poll() is not None:
+                raise RuntimeError("Stub exited with {}".format(stub.returncode))
+            time.sleep(0.2)
+    stub.kill()
+    raise RuntimeError("Stub didn't start in time")
+
+
+def run_scenario(scenario):
+    port = free_port()
+    stub = start_stub(scenario, port)
+    fd, output = tempfile.mkstemp(prefix="esdedupe-bench-", suffix=".json")
+    os.close(fd)
+    try:
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.run",
+                "--child",
+                json.dumps(scenario),
+                "--port",
+                str(port),
+                "--output",
+                output,
+            ],
+            check=True,
+        )
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.unlink(output)
+        stub.terminate()
+        stub.wait()
+
+
+# (current, peak) resident memory of this process in bytes
+def rss():
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f)
+        return (
+            int(status["VmRSS"].split()[0]) * 1024,
+            int(status["VmHWM"].split()[0]) * 1024,
+        )
+    except (OSError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        if sys.platform != "darwin":
+            peak *= 1024
+        return peak, peak
+
+
+# reset peak RSS (VmHWM) to current RSS, Linux only
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+# hits with the same shape (and duplicates ratio) as served by the stub
+def synthetic_hits(docs, dupl, seed=1):
+    rnd = random.Random(seed)
+    keys = []
+    for i in range(docs):
+        if i > 0 and rnd.random() < dupl:
+            key = keys[rnd.randrange(i)]
+        else:
+            key = rnd.getrandbits(128)
+        keys.append(key)
+        yield {"_id": "doc-{}".format(i), "_source": {"Uuid": str(uuid.UUID(int=key))}}
+
+
+def child(scenario, port, output):
+    from elasticsearch import Elasticsearch
+
+    from esdedupe.cli import ArgumentParser
+    from esdedupe.esdedupe import Esdedupe
+    from esdedupe.fields import KeyBuilder
+
+    logging.basicConfig(level=logging.WARNING)
+    argv = [
+        "-H",
+        "127.0.0.1",
+        "-P",
+        str(port),
+        "-i",
+        "bench",
+        "-f",
+        "Uuid",
+        "--no-progress",
+        "-b",
+        str(scenario["batch"]),
+        "--flush",
+        str(scenario["flush"]),
+        "-j",
+        str(scenario["threads"]),
+        "--delete-engine",
+        scenario["delete_engine"],
+        "--scan-slices",
+        str(scenario["scan_slices"]),
+    ]
+    if scenario["store"] == "spill":
+        argv += ["--spill-memory", scenario["spill_memory"]]
+    args = ArgumentParser(prog="esdedupe").parse_args(argv)
+    dedupe = Esdedupe()
+    es = Elasticsearch(**dedupe.client_kwargs(args))
+    pk = KeyBuilder(["Uuid"])
+    index = "bench"
+    phases = {}
+
+    def measure(name, items, fn):
+        reset_peak_rss()
+        before = rss()[0]
+        start = time.time()
+        result = fn()
+        seconds = time.time() - start
+        peak = rss()[1]
+        phases[name] = {
+            "seconds": seconds,
+            "items": items() if callable(items) else items,
+            "peak_rss": peak,
+            "rss_growth": max(peak - before, 0),
+        }
+        phases[name]["rate"] = phases[name]["items"] / seconds if seconds else 0
+        return result
+
+    docs = dedupe.new_store(args)
+    try:
+        dupl = measure(
+            "scan",
+            scenario["docs"],
+            lambda: dedupe.scan(es, docs, pk, index, args),
+        )
+        measure(
+            "delete_iterator",
+            dupl,
+            lambda: sum([1 for _ in dedupe.delete_iterator(docs, index, args)]),
+        )
+        measure(
+            "bulk",
+            dupl,
+            lambda: dedupe.bulk_delete(
+                dedupe.delete_iterator(docs, index, args), es, args, dupl
+            ),
+        )
+    finally:
+        docs.close()
+
+    # generating hits isn't part of build_index, they are held in memory
+    # before the phase starts (and don't count into its RSS growth)
+    hits = list(synthetic_hits(scenario["docs"], scenario["dupl"]))
+    store = dedupe.new_store(args)
+
+    def build():
+        for hit in hits:
+            dedupe.build_index(store, pk, hit)
+
+    try:
+        measure("build_index", scenario["docs"], build)
+        phases["build_index"]["mapping_bytes"] = store.nbytes()
+    finally:
+        store.close()
+
+    with open(output, "w") as f:
+        json.dump({"scenario": scenario, "phases": phases}, f)
+
+
+def report(results):
+    print(
+        "{:<70} {:<16} {:>9} {:>12} {:>10} {:>10}".format(
+            "scenario", "phase", "time", "items/s", "peak RSS", "growth"
+        )
+    )
+    for result in results:
+        name = scenario_name(result["scenario"])
+        for phase in PHASES:
+            stats = result["phases"][phase]
+            print(
+                "{:<70} {:<16} {:>8.2f}s {:>12,.0f} {:>8.1f}MB {:>8.1f}MB".format(
+                    name,
+                    phase,
+                    stats["seconds"],
+                    stats["rate"],
+                    stats["peak_rss"] / 1024**2,
+                    stats.get("rss_growth", 0) / 1024**2,
+                )
+            )
+
+
+# list of regressions compared to baseline results
+def compare(results, baseline, tolerance):
+    previous = {scenario_name(r["scenario"]): r["phases"] for r in baseline}
+    regressions = []
+    for result in results:
+        name = scenario_name(result["scenario"])
+        if name not in previous:
+            continue
+        for phase in PHASES:
+            old = previous[name].get(phase)
+            new = result["phases"][phase]
+            if old is None:
+                continue
+            if new["rate"] < old["rate"] * (1 - tolerance):
+                regressions.append(
+                    "{} {}: {:,.0f} items/s, baseline {:,.0f}".format(
+                        name, phase, new["rate"], old["rate"]
+                    )
+                )
+            if new["peak_rss"] > old["peak_rss"] * (1 + tolerance):
+                regressions.append(
+                    "{} {}: peak RSS {:.1f}MB, baseline {:.1f}MB".format(
+                        name,
+                        phase,
+                        new["peak_rss"] / 1024**2,
+                        old["peak_rss"] / 1024**2,
+                    )
+                )
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.child:
+        return child(json.loads(args.child), args.port, args.output)
+
+    results = [run_scenario(scenario) for scenario in scenarios(args)]
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+# Minimal Elasticsearch stand-in for benchmarks. Serves a single synthetic
+# index of `--docs` documents where roughly `--dupl` of them repeat the key
+# of an earlier document. Supports just enough of the API for scanning
+# (scroll, sliced scroll), bulk deletes, delete_by_query tasks (and their
+# results in .tasks), mget and count. Documents are rendered on the fly,
+# deletes are kept in memory.
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+HIT = (
+    '{{"_index":"{index}","_id":"doc-{i}","_score":1.0,'
+    '"_source":{{"Uuid":"{key}","timestamp":"{ts}"}}}}'
+)
+
+
+class Index:
+    def __init__(self, name, docs, dupl, seed=1):
+        self.name = name
+        self.docs = docs
+        self.deleted = bytearray(docs)
+        self.lock = threading.Lock()
+        self.scrolls = {}
+        self.tasks = {}
+        self.submitted = 0
+        rnd = random.Random(seed)
+        self.keys = []
+        for i in range(docs):
+            if i > 0 and rnd.random() < dupl:
+                self.keys.append(self.keys[rnd.randrange(i)])
+            else:
+                self.keys.append(rnd.getrandbits(128))
+
+    def hit(self, i):
+        return HIT.format(
+            index=self.name,
+            i=i,
+            key=uuid.UUID(int=self.keys[i]),
+            ts="2021-01-01T{:02d}:{:02d}:{:02d}.000Z".format(
+                i // 3600 % 24, i // 60 % 60, i % 60
+            ),
+        )
+
+    def alive(self, slice_id=0, slices=1):
+        deleted = self.deleted
+        return [i for i in range(slice_id, self.docs, slices) if not deleted[i]]
+
+    def delete(self, doc_id):
+        i = int(doc_id[4:])
+        with self.lock:
+            found = not self.deleted[i]
+            self.deleted[i] = 1
+        return found
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    index = None
+    # seconds per bulk item, simulates indexing cost
+    bulk_latency = 0.0
+    # probability of rejecting a bulk item (HTTP 429)
+    reject = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, raw, status=200):
+        if isinstance(raw, str):
+            raw = raw.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def reply(self, body, status=200):
+        self.send(json.dumps(body), status)
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+    def do_HEAD(self):
+        self.route("HEAD")
+
+    def route(self, method):
+        url = urlparse(self.path)
+        qs = {k: v[0] for k, v in parse_qs(url.query).items()}
+        size = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(size) if size else b""
+        path = url.path
+        if path == "/":
+            return self.reply(
+                {
+                    "name": "stub",
+                    "cluster_name": "esdedupe-bench",
+                    "version": {"number": "8.15.0"},
+                    "tagline": "You Know, for Search",
+                }
+            )
+        if path == "/_search/scroll":
+            if method == "DELETE":
+                return self.reply({"succeeded": True, "num_freed": 1})
+            return self.scroll(json.loads(raw)["scroll_id"])
+        if path.endswith("/_search"):
+            return self.search(json.loads(raw) if raw else {}, qs)
+        if path.endswith("/_bulk"):
+            return self.bulk(raw)
+        if path.endswith("/_mget"):
+            return self.mget(json.loads(raw))
+        if path.endswith("/_delete_by_query"):
+            return self.delete_by_query(json.loads(raw))
+        if path.startswith("/_tasks/"):
+            return self.task(unquote(path[len("/_tasks/") :]))
+        if path.startswith("/.tasks/_doc/") and method == "DELETE":
+            return self.forget(unquote(path[len("/.tasks/_doc/") :]))
+        if path.endswith("/_count"):
+            return self.reply({"count": len(self.index.alive())})
+        self.reply({"error": "unsupported endpoint {} {}".format(method, path)}, 400)
+
+    def search(self, body, qs):
+        sl = body.get("slice", {"id": 0, "max": 1})
+        alive = self.index.alive(sl["id"], sl["max"])
+        size = int(qs.get("size", body.get("size", 10)))
+        scroll_id = uuid.uuid4().hex
+        self.index.scrolls[scroll_id] = [alive, 0, size]
+        self.scroll(scroll_id)
+
+    def scroll(self, scroll_id):
+        state = self.index.scrolls[scroll_id]
+        alive, pos, size = state
+        state[1] = pos + size
+        hits = ",".join([self.index.hit(i) for i in alive[pos : pos + size]])
+        self.send(
+            '{{"_scroll_id":"{}","took":1,"timed_out":false,'
+            '"_shards":{{"total":1,"successful":1,"skipped":0,"failed":0}},'
+            '"hits":{{"total":{{"value":{},"relation":"eq"}},"hits":[{}]}}}}'.format(
+                scroll_id, len(alive), hits
+            )
+        )
+
+    def bulk(self, raw):
+        items = []
+        errors = False
+        for line in raw.splitlines():
+            if not line.strip():
+                continue
+            meta = json.loads(line)["delete"]
+            if self.reject and random.random() < self.reject:
+                errors = True
+                items.append(
+                    {
+                        "delete": {
+                            "_index": meta["_index"],
+                            "_id": meta["_id"],
+                            "status": 429,
+                            "error": {"type": "es_rejected_execution_exception"},
+                        }
+                    }
+                )
+                continue
+            found = self.index.delete(meta["_id"])
+            items.append(
+                {
+                    "delete": {
+                        "_index": meta["_index"],
+                        "_id": meta["_id"],
+                        "status": 200 if found else 404,
+                        "result": "deleted" if found else "not_found",
+                        "_shards": {"total": 2, "successful": 2, "failed": 0},
+                    }
+                }
+            )
+        if self.bulk_latency:
+            time.sleep(len(items) * self.bulk_latency)
+        self.reply({"took": 1, "errors": errors, "items": items})
+
+    # deletes right away, the task completes after bulk_latency per document
+    def delete_by_query(self, body):
+        deleted = 0
+        for doc_id in body["query"]["ids"]["values"]:
+            if self.index.delete(doc_id):
+                deleted += 1
+        with self.index.lock:
+            self.index.submitted += 1
+            task = "stub:{}".format(self.index.submitted)
+            self.index.tasks[task] = (
+                time.time() + deleted * self.bulk_latency,
+                {"deleted": deleted, "version_conflicts": 0, "failures": []},
+            )
+        self.reply({"task": task})
+
+    def task(self, task):
+        until, response = self.index.tasks[task]
+        if time.time() < until:
+            return self.reply({"completed": False, "task": {}})
+        self.reply({"completed": True, "task": {}, "response": response})
+
+    # result of completed task removed from .tasks index
+    def forget(self, task):
+        with self.index.lock:
+            found = self.index.tasks.pop(task, None) is not None
+        result = "deleted" if found else "not_found"
+        self.reply(
+            {"_index": ".tasks", "_id": task, "result": result}, 200 if found else 404
+        )
+
+    def mget(self, body):
+        docs = []
+        for doc_id in body["ids"]:
+            found = not self.index.deleted[int(doc_id[4:])]
+            docs.append({"_index": self.index.name, "_id": doc_id, "found": found})
+        self.reply({"docs": docs})
+
+
+def serve(port, docs, dupl, index="bench", bulk_latency=0.0, reject=0.0, seed=1):
+    Handler.index = Index(index, docs, dupl, seed)
+    Handler.bulk_latency = bulk_latency
+    Handler.reject = reject
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Elasticsearch stand-in")
+    parser.add_argument("--port", type=int, default=9299)
+    parser.add_argument("--docs", type=int, default=100000)
+    parser.add_argument("--dupl", type=float, default=0.1)
+    parser.add_argument("--index", default="bench")
+    parser.add_argument("--bulk-latency", type=float, default=0.0)
+    parser.add_argument("--reject", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    serve(
+        args.port,
+        args.docs,
+        args.dupl,
+        args.index,
+        args.bulk_latency,
+        args.reject,
+        args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
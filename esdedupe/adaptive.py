@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+import collections
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from elasticsearch.helpers import expand_action
+from logging import getLogger
+
+REJECTED = "es_rejected_execution_exception"
+
+
+# Bulk delete with chunk size and concurrency driven by cluster feedback.
+#
+# Chunk size grows while bulk requests are faster than target latency, once
+# it reaches its maximum, concurrency is increased (up to --threads). Slow
+# requests shrink the chunk, rejections (HTTP 429, rejected items or growing
+# rejected count of write thread pool) halve the chunk, drop concurrency and
+# back off exponentially. Rejected items are retried up to --max_retries.
+# Optional --max-rate is a hard ceiling of deleted documents per second.
+class AdaptiveBulk:
+    MIN_CHUNK = 10
+    GROW = 1.25
+    SHRINK = 0.5
+    SLOW = 1.5
+    MAX_BACKOFF = 60
+    POLL_INTERVAL = 10
+
+    def __init__(self, es, args):
+        self.log = getLogger("esdedupe")
+        self.es = es.options(request_timeout=args.request_timeout)
+        self.chunk = max(args.flush, self.MIN_CHUNK)
+        self.max_chunk = max(args.max_flush, self.chunk)
+        self.concurrency = 1
+        self.max_concurrency = max(args.threads, 1)
+        self.target = args.target_latency
+        self.max_rate = args.max_rate
+        self.max_retries = args.max_retries
+        self.initial_backoff = args.initial_backoff
+        self.fail_fast = args.fail_fast
+        self.successes = 0
+        self.failed = 0
+        self.rejected = 0
+        self.retries = 0
+        self._pressure_count = 0
+        self._busy = False
+        self._sent = 0
+        self._start = None
+        self._last_poll = 0
+        self._pool_rejected = None
+        self._poll = True
+
+    def run(self, actions, progress=None):
+        actions = iter(actions)
+        retry = collections.deque()
+        pending = {}
+        self._start = time.time()
+        with ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="bulk"
+        ) as pool:
+            while True:
+                while len(pending) < self.concurrency:
+                    chunk = self._next_chunk(actions, retry)
+                    if not chunk:
+                        break
+                    self._throttle(len(chunk))
+                    pending[pool.submit(self._send, chunk)] = chunk
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk = pending.pop(future)
+                    self._handle(future.result(), chunk, retry, progress)
+                self._poll_thread_pool()
+        return self.successes
+
+    # retried actions go first, chunk items are (attempt, action) tuples
+    def _next_chunk(self, actions, retry):
+        chunk = []
+        while retry and len(chunk) < self.chunk:
+            chunk.append(retry.popleft())
+        for action in actions:
+            chunk.append((0, action))
+            if len(chunk) >= self.chunk:
+                break
+        return chunk
+
+    def _throttle(self, size):
+        if self.max_rate:
+            ahead = self._sent / self.max_rate - (time.time() - self._start)
+            if ahead > 0:
+                time.sleep(ahead)
+        self._sent += size
+
+    def _send(self, chunk):
+        operations = []
+        for attempt, action in chunk:
+            meta, data = expand_action(action)
+            operations.append(meta)
+            if data is not None:
+                operations.append(data)
+        start = time.time()
+        try:
+            resp = self.es.bulk(operations=operations)
+            return resp, time.time() - start, None
+        except Exception as e:
+            return None, time.time() - start, e
+
+    def _handle(self, result, chunk, retry, progress):
+        resp, latency, error = result
+        processed = 0
+        rejected = []
+        if error is not None:
+            if getattr(error, "status_code", None) == 429:
+                rejected = chunk
+            elif self.fail_fast:
+                raise error
+            else:
+                self.log.error(error)
+                self.failed += len(chunk)
+                processed = len(chunk)
+        else:
+            for (attempt, action), item in zip(chunk, resp["items"]):
+                op = next(iter(item.values()))
+                status = op.get("status", 200)
+                if status == 429 or op.get("error", {}).get("type") == REJECTED:
+                    rejected.append((attempt, action))
+                    continue
+                processed += 1
+                if status < 300:
+                    self.successes += op["_shards"]["successful"]
+                elif status != 404:
+                    # 404 - document has been already deleted
+                    self.failed += 1
+                    print("Doc failed", item)
+        for attempt, action in rejected:
+            self.rejected += 1
+            if attempt >= self.max_retries:
+                self.failed += 1
+                processed += 1
+                print("Doc failed, retries exhausted", action)
+            else:
+                self.retries += 1
+                retry.append((attempt + 1, action))
+        if progress is not None and processed:
+            progress.update(processed)
+        if rejected:
+            self._pressure("{} rejected actions".format(len(rejected)))
+        else:
+            self._feedback(latency, len(chunk))
+
+    def _feedback(self, latency, size):
+        self._pressure_count = 0
+        if latency > self.target * self.SLOW:
+            if self.chunk > self.MIN_CHUNK:
+                self.chunk = max(self.MIN_CHUNK, int(self.chunk * 0.8))
+            elif self.concurrency > 1:
+                self.concurrency -= 1
+        elif latency < self.target and size >= self.chunk and not self._busy:
+            if self.chunk < self.max_chunk:
+                self.chunk = min(self.max_chunk, int(self.chunk * self.GROW) + 1)
+            elif self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+        self.log.debug(
+            "Bulk of {} took {:.2f}s, next chunk: {}, concurrency: {}".format(
+                size, latency, self.chunk, self.concurrency
+            )
+        )
+
+    def _pressure(self, reason):
+        self.chunk = max(self.MIN_CHUNK, int(self.chunk * self.SHRINK))
+        self.concurrency = max(1, self.concurrency - 1)
+        backoff = min(self.initial_backoff * 2**self._pressure_count, self.MAX_BACKOFF)
+        self._pressure_count += 1
+        self.log.info(
+            "Cluster under pressure ({}), chunk: {}, concurrency: {}, backing off {}s".format(
+                reason, self.chunk, self.concurrency, backoff
+            )
+        )
+        time.sleep(backoff)
+
+    # rejections and queue of write thread pool across all nodes
+    def _poll_thread_pool(self):
+        now = time.time()
+        if not self._poll or now - self._last_poll < self.POLL_INTERVAL:
+            return
+        self._last_poll = now
+        try:
+            rows = self.es.cat.thread_pool(
+                thread_pool_patterns="write",
+                format="json",
+                h="node_name,queue,queue_size,rejected",
+            )
+        except Exception as e:
+            self.log.debug("Unable to read thread pool stats: {}".format(e))
+            self._poll = False
+            return
+        rejected = sum([int(row.get("rejected") or 0) for row in rows])
+        self._busy = any(
+            int(row.get("queue") or 0) * 2 > int(row.get("queue_size") or 1)
+            for row in rows
+        )
+        previous = self._pool_rejected
+        self._pool_rejected = rejected
+        if previous is not None and rejected > previous:
+            self._pressure(
+                "write thread pool rejected {} requests".format(rejected - previous)
+            )
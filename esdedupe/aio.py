@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+import asyncio
+import sys
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch import ConnectionError as ESConnectionError
+from elasticsearch.helpers import async_scan, async_streaming_bulk
+
+from .esdedupe import Esdedupe
+from .utils import bytes_fmt, memusage
+
+
+def async_available():
+    try:
+        import aiohttp  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# Asyncio execution path, scroll, mget and bulk requests are sent using
+# AsyncElasticsearch, up to --max-inflight requests are kept in flight.
+# Every phase runs its own event loop, the rest of the workflow (windows,
+# reporting) is shared with Esdedupe.
+class AsyncEsdedupe(Esdedupe):
+    def run(self, args):
+        if not async_available():
+            self.log.error(
+                "--async requires aiohttp, install it using: pip install elasticsearch[async]"
+            )
+            sys.exit(1)
+        if args.engine != "scan" or args.online or args.prefilter:
+            self.log.error(
+                "--async supports only scan engine without --online and --prefilter"
+            )
+            sys.exit(1)
+        super(AsyncEsdedupe, self).run(args)
+
+    def async_client(self, args):
+        return AsyncElasticsearch(
+            request_timeout=args.request_timeout, **self.client_kwargs(args)
+        )
+
+    def ping(self, args):
+        asyncio.run(self.async_ping(args))
+
+    async def async_ping(self, args):
+        uri = self.elastic_uri(args)
+        async with self.async_client(args) as aes:
+            try:
+                resp = await aes.info()
+                self.log.debug("Response: {0}".format(resp))
+            except ESConnectionError as e:
+                self.log.error("Connection failed. Is ES running on {0} ?".format(uri))
+                self.log.error("Check --host argument and --port")
+                self.log.error(e)
+                sys.exit(1)
+
+    def detect(self, es, docs_hash, unique_fields, index, args):
+        return asyncio.run(self.async_scan(docs_hash, unique_fields, index, args))
+
+    # With --scan-slices every slice is read by its own coroutine, mapping
+    # is modified only from the event loop thread
+    async def async_scan(self, docs_hash, unique_fields, index, args):
+        self.log.info(
+            "Building documents mapping on index: {}, batch size: {}, slices: {} (async)".format(
+                index, args.batch, args.scan_slices
+            )
+        )
+        query = self.es_query(args, unique_fields)
+        if args.scan_slices > 1:
+            queries = [
+                dict(query, slice={"id": i, "max": args.scan_slices})
+                for i in range(args.scan_slices)
+            ]
+        else:
+            queries = [query]
+        scanned = [0]
+        cache = self.caches.get(index)
+
+        async def read(aes, q):
+            async for hit in async_scan(
+                aes,
+                index=index,
+                query=q,
+                size=args.batch,
+                scroll=args.scroll,
+                request_timeout=args.request_timeout,
+            ):
+                self.build_index(docs_hash, unique_fields, hit)
+                if cache is not None:
+                    self.remember(cache, unique_fields, hit, args)
+                scanned[0] += 1
+                if scanned[0] % args.mem_report == 0:
+                    self.metrics.inc("esdedupe_docs_scanned_total", args.mem_report)
+                    self.metrics.mapping(docs_hash)
+                    self.log.debug(
+                        "Scanned {:0,} documents, mapping size: {}, memory usage: {}".format(
+                            docs_hash.docs, bytes_fmt(docs_hash.nbytes()), memusage()
+                        )
+                    )
+
+        async with self.async_client(args) as aes:
+            await asyncio.gather(*[read(aes, q) for q in queries])
+        self.metrics.inc("esdedupe_docs_scanned_total", scanned[0] % args.mem_report)
+        dupl = self.count_duplicates(docs_hash)
+        self.metrics.mapping(docs_hash, len(docs_hash))
+        return dupl
+
+    def print_duplicates(self, docs_hash, index, es, args):
+        asyncio.run(self.async_print_duplicates(docs_hash, index, args))
+
+    async def async_print_duplicates(self, docs_hash, index, args):
+        limit = asyncio.Semaphore(args.max_inflight)
+        params = self.print_params(args)
+
+        async def fetch(aes, batch):
+            ids = [doc_id for key, doc_id, keep in batch]
+            async with limit:
+                resp = await aes.mget(index=index, ids=ids, **params)
+            return batch, resp["docs"]
+
+        with self.print_output(args) as out:
+            async with self.async_client(args) as aes:
+                pending = []
+                groups = docs_hash.duplicate_groups()
+                for batch in self.doc_batches(groups, args.batch):
+                    pending.append(fetch(aes, batch))
+                    if len(pending) >= args.max_inflight:
+                        for batch, docs in await asyncio.gather(*pending):
+                            self.print_docs(out, batch, docs)
+                        pending = []
+                for batch, docs in await asyncio.gather(*pending):
+                    self.print_docs(out, batch, docs)
+
+    def bulk_delete(self, actions, es, args, total=None, progress=None):
+        if args.delete_engine == "dbq":
+            # deleted by the cluster, nothing to gain from asyncio
+            return self.delete_by_query(actions, es, args, total, progress)
+        if args.delete_engine == "adaptive":
+            # tuned by cluster feedback, runs its own worker threads
+            return self.bulk_adaptive(actions, es, args, total, progress)
+        return asyncio.run(self.async_bulk_delete(actions, args, total, progress))
+
+    # Actions are distributed among --max-inflight bulk streams
+    async def async_bulk_delete(self, actions, args, total=None, progress=None):
+        pending = asyncio.Queue(maxsize=args.flush * args.max_inflight)
+        done = object()
+        successes = [0]
+        progress = self.progress_bar(args, total, progress)
+
+        async def produce():
+            for action in actions:
+                await pending.put(action)
+            for i in range(args.max_inflight):
+                await pending.put(done)
+
+        async def stream(finished):
+            while True:
+                action = await pending.get()
+                if action is done:
+                    finished.append(True)
+                    return
+                yield action
+
+        # with --fail-fast the first error cancels all streams, otherwise the
+        # error is logged and the stream continues with next actions, so that
+        # producer won't block. Actions of the failed chunk (and any already
+        # buffered by bulk helper) aren't sent.
+        async def consume(aes):
+            finished = []
+            while not finished:
+                try:
+                    async for success, info in async_streaming_bulk(
+                        aes,
+                        stream(finished),
+                        chunk_size=args.flush,
+                        max_retries=args.max_retries,
+                        initial_backoff=args.initial_backoff,
+                        raise_on_exception=args.fail_fast,
+                    ):
+                        if success:
+                            deleted = info["delete"]["_shards"]["successful"]
+                            successes[0] += deleted
+                            self.metrics.inc("esdedupe_docs_deleted_total", deleted)
+                        else:
+                            print("Doc failed", info)
+                        if progress is not None:
+                            progress.update(1)
+                except Exception as e:
+                    if args.fail_fast:
+                        raise
+                    self.log.error(e)
+
+        async with self.async_client(args) as aes:
+            await asyncio.gather(
+                produce(), *[consume(aes) for i in range(args.max_inflight)]
+            )
+
+        self.log.info(
+            "Deleted {:0,} documents (including shard replicas)".format(successes[0])
+        )
+        return successes[0]
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+import hashlib
+import math
+
+
+# Bloom filter sized for `capacity` keys with given false positive rate.
+# Bit positions are derived from a single blake2b digest of the key using
+# double hashing (h1 + i * h2), keys don't have to be uniformly distributed.
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        if not 0 < error_rate < 1:
+            raise ValueError("Bloom filter error rate has to be within (0, 1)")
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(
+            int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8
+        )
+        self.hashes = max(int(round(self.bits / capacity * math.log(2))), 1)
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        # odd step never degenerates to a single bit
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+    # Add key, returns True when the key might have been added before (all
+    # its bits were already set), False when it's certainly new
+    def add(self, key):
+        array = self._array
+        seen = True
+        for pos in self._positions(key):
+            byte = pos >> 3
+            mask = 1 << (pos & 7)
+            if not array[byte] & mask:
+                seen = False
+                array[byte] |= mask
+        return seen
+
+    def __contains__(self, key):
+        array = self._array
+        for pos in self._positions(key):
+            if not array[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def nbytes(self):
+        return len(self._array)
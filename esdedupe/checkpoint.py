@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import threading
+import ujson
+
+
+# Progress of a run persisted as JSON, so that an interrupted run can be
+# resumed. For every index it records completed time windows, whether the
+# whole index is done, number of removed documents and position within
+# the current window (used by the sorted engine: sort values and key of the
+# last document whose deletion has been acknowledged).
+#
+# The file is replaced atomically on every save, it's safe to kill the
+# process at any time.
+class Checkpoint:
+    VERSION = 1
+
+    def __init__(self, path, field):
+        self.path = path
+        self._lock = threading.Lock()
+        self.state = {"version": self.VERSION, "field": field, "indices": {}}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                state = ujson.load(f)
+            if state.get("version") != self.VERSION:
+                raise ValueError(
+                    "Unsupported checkpoint version {} in {}".format(
+                        state.get("version"), path
+                    )
+                )
+            if state.get("field") != field:
+                raise ValueError(
+                    "Checkpoint {} was created for fields '{}', not '{}'".format(
+                        path, state.get("field"), field
+                    )
+                )
+            self.state = state
+
+    # `since`/`until` are ES formatted dates, None for index without windows
+    @staticmethod
+    def window_key(since, until):
+        return "{}/{}".format(since, until)
+
+    def _index(self, index):
+        return self.state["indices"].setdefault(
+            index, {"done": False, "removed": 0, "windows": [], "current": None}
+        )
+
+    def index_done(self, index):
+        with self._lock:
+            return self._index(index)["done"]
+
+    def window_done(self, index, window):
+        with self._lock:
+            return window in self._index(index)["windows"]
+
+    # number of documents removed from index by previous runs
+    def removed(self, index):
+        with self._lock:
+            return self._index(index)["removed"]
+
+    # position within unfinished window, None when it should be started over
+    def position(self, index, window):
+        with self._lock:
+            current = self._index(index)["current"]
+            if current is None or current["window"] != window:
+                return None
+            return current["position"]
+
+    # deletion of everything up to `position` has been acknowledged
+    def advance(self, index, window, position):
+        with self._lock:
+            self._index(index)["current"] = {"window": window, "position": position}
+            self._save()
+
+    # [since, until] pairs of --window auto
+    def plan(self, index):
+        with self._lock:
+            return self._index(index).get("plan")
+
+    def save_plan(self, index, windows):
+        with self._lock:
+            self._index(index)["plan"] = windows
+            self._save()
+
+    def complete_window(self, index, window, removed):
+        with self._lock:
+            state = self._index(index)
+            state["windows"].append(window)
+            state["current"] = None
+            state["removed"] += removed
+            self._save()
+
+    def complete_index(self, index, removed=0):
+        with self._lock:
+            state = self._index(index)
+            state["done"] = True
+            state["current"] = None
+            state["removed"] += removed
+            self._save()
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(prefix=".checkpoint-", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                ujson.dump(self.state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
@@ -6,6 +6,8 @@ import datetime
 
 from argparse import ArgumentParser as _Base
 
+from .fields import SEPARATOR
+
 
 class ArgumentParser(_Base):
     def __init__(self, *args, **kwargs):
@@ -17,8 +19,9 @@ class ArgumentParser(_Base):
             "--all",
             action="store_true",
             dest="all",
-            default=True,
-            help="All indexes from given date till today",
+            default=False,
+            help="""Process all indexes matching --prefix (except those
+                          matching --indexexclude)""",
         )
         self.add_argument(
             "-b",
@@ -44,6 +47,51 @@ class ArgumentParser(_Base):
             help="Field in ES that is supposed to be unique",
             metavar="field",
         )
+        self.add_argument(
+            "-e",
+            "--engine",
+            dest="engine",
+            default="scan",
+            choices=["scan", "composite", "sorted"],
+            help="""Duplicates detection: 'scan' builds mapping of all documents,
+                          'composite' finds duplicate keys using composite
+                          aggregation and fetches only duplicate documents,
+                          'sorted' streams documents sorted by unique fields
+                          and deletes adjacent duplicates (both require
+                          single-valued aggregatable fields), default: scan""",
+        )
+        self.add_argument(
+            "--fetch",
+            dest="fetch",
+            default="source",
+            choices=["source", "docvalue", "stored"],
+            help="""Where to read unique fields from: filtered _source,
+                          docvalue_fields or stored_fields (fields have to be
+                          mapped as keyword/numeric or stored), default: source""",
+        )
+        self.add_argument(
+            "--key-hash",
+            dest="key_hash",
+            default="md5",
+            choices=["md5", "blake2b", "xxhash", "none"],
+            help="""Function turning unique fields into fixed width keys,
+                          'none' keeps raw values (requires --key-size),
+                          default: md5""",
+        )
+        self.add_argument(
+            "--key-size",
+            dest="key_size",
+            default=None,
+            type=int,
+            help="""Key size in bytes: 1-64 for blake2b, 8 or 16 for xxhash,
+                          longest value + 1 for 'none', default: 16""",
+        )
+        self.add_argument(
+            "--key-separator",
+            dest="key_separator",
+            default=SEPARATOR,
+            help="Separator of multiple unique fields values, default: ASCII unit separator (0x1f)",
+        )
         self.add_argument(
             "--flush",
             dest="flush",
@@ -51,6 +99,45 @@ class ArgumentParser(_Base):
             type=int,
             help="Number records send in one bulk request",
         )
+        self.add_argument(
+            "--delete-engine",
+            dest="delete_engine",
+            default="bulk",
+            choices=["bulk", "adaptive", "dbq"],
+            help="""'bulk' uses fixed --flush and --threads, 'adaptive' tunes
+                          chunk size (up to --max-flush) and concurrency (up
+                          to --threads) according to bulk latency and
+                          rejections, 'dbq' submits up to --threads server side
+                          _delete_by_query tasks of --dbq-batch IDs, default: bulk""",
+        )
+        self.add_argument(
+            "--dbq-batch",
+            dest="dbq_batch",
+            default=10000,
+            type=int,
+            help="Number of IDs deleted by a single delete_by_query task, default: 10000",
+        )
+        self.add_argument(
+            "--max-flush",
+            dest="max_flush",
+            default=5000,
+            type=int,
+            help="Maximum bulk size for adaptive delete, default: 5000",
+        )
+        self.add_argument(
+            "--target-latency",
+            dest="target_latency",
+            default=1.0,
+            type=float,
+            help="Bulk request latency (seconds) adaptive delete aims for, default: 1.0",
+        )
+        self.add_argument(
+            "--max-rate",
+            dest="max_rate",
+            default=0,
+            type=float,
+            help="Maximum number of deleted documents per second for adaptive and dbq delete, default: unlimited",
+        )
         self.add_argument(
             "-i",
             "--index",
@@ -68,6 +155,21 @@ class ArgumentParser(_Base):
                           name that is to be excluded, only useful with --all""",
             metavar="indexexclude-regexp",
         )
+        self.add_argument(
+            "--index-concurrency",
+            dest="index_concurrency",
+            default=1,
+            type=int,
+            help="Number of indexes processed concurrently in --all mode, default: 1",
+        )
+        self.add_argument(
+            "--index-order",
+            dest="index_order",
+            default="name",
+            choices=["name", "size", "date"],
+            help="""Order of indexes in --all mode: by name, by size (largest
+                          first) or by creation date (oldest first)""",
+        )
         self.add_argument(
             "-j",
             "--threads",
@@ -131,7 +233,34 @@ class ArgumentParser(_Base):
             "--window",
             dest="window",
             default=None,
-            help="Time window, requires --timestamp and --since flags",
+            help="""Time window (e.g. 30m, 1h), requires --timestamp, --since
+                          and --until flags. 'auto' splits the time range into
+                          windows of roughly --window-docs documents""",
+        )
+        self.add_argument(
+            "--window-docs",
+            dest="window_docs",
+            default=1000000,
+            type=int,
+            help="Target number of documents per window for --window auto, default: 1000000",
+        )
+        self.add_argument(
+            "--lookback",
+            dest="lookback",
+            default=None,
+            help="""Keep keys of documents from the last LOOKBACK (e.g. 30s,
+                          5m) of every window, documents of the next window
+                          with such key are duplicates too""",
+            metavar="LOOKBACK",
+        )
+        self.add_argument(
+            "--window-concurrency",
+            dest="window_concurrency",
+            default=1,
+            type=int,
+            help="""Number of time windows processed at the same time, every
+                          window has its own mapping and scroll (--spill-memory
+                          budget is split among them), default: 1""",
         )
         self.add_argument(
             "-v",
@@ -165,6 +294,74 @@ class ArgumentParser(_Base):
                           Any subsequent retries will be powers of
                           initial_backoff * 2**retry_number""",
         )
+        self.add_argument(
+            "--scan-slices",
+            dest="scan_slices",
+            default=1,
+            type=int,
+            help="""Number of slices read concurrently using sliced scroll,
+                          usually shouldn't exceed number of shards, default: 1""",
+        )
+        self.add_argument(
+            "--async",
+            action="store_true",
+            dest="use_async",
+            default=False,
+            help="""Use asyncio client for scroll, mget and bulk requests
+                          (requires aiohttp)""",
+        )
+        self.add_argument(
+            "--max-inflight",
+            dest="max_inflight",
+            default=4,
+            type=int,
+            help="Maximum number of concurrent bulk/mget requests in --async mode",
+        )
+        self.add_argument(
+            "--online",
+            action="store_true",
+            dest="online",
+            default=False,
+            help="""Delete duplicates while scanning (first seen document is
+                          kept), mapping holds only keys""",
+        )
+        self.add_argument(
+            "--prefilter",
+            action="store_true",
+            dest="prefilter",
+            default=False,
+            help="""Scan index twice, keys of all documents go through a Bloom
+                          filter first, document IDs are stored only for
+                          possible duplicates""",
+        )
+        self.add_argument(
+            "--prefilter-error",
+            dest="prefilter_error",
+            default=0.01,
+            type=float,
+            help="False positive rate of --prefilter Bloom filter, default: 0.01",
+        )
+        self.add_argument(
+            "--online-queue",
+            dest="online_queue",
+            default=10000,
+            type=int,
+            help="Maximum number of delete actions waiting to be sent in --online mode",
+        )
+        self.add_argument(
+            "--spill-memory",
+            dest="spill_memory",
+            default=None,
+            help="""Memory budget for documents mapping (e.g. 512M, 2G), when
+                          reached mapping is sorted and written to disk,
+                          duplicates are found by merging sorted runs""",
+        )
+        self.add_argument(
+            "--spill-dir",
+            dest="spill_dir",
+            default=None,
+            help="Directory for temporary files of --spill-memory mode, default: system temp",
+        )
         self.add_argument(
             "--scroll",
             dest="scroll",
@@ -178,6 +375,23 @@ class ArgumentParser(_Base):
             type=int,
             help="Elasticsearch timeout in seconds",
         )
+        self.add_argument(
+            "--checkpoint",
+            dest="checkpoint",
+            default=None,
+            help="""JSON file recording progress (completed indices and
+                          windows, position of sorted engine), an interrupted
+                          run started with the same file resumes where it
+                          stopped""",
+            metavar="FILE",
+        )
+        self.add_argument(
+            "--checkpoint-interval",
+            dest="checkpoint_interval",
+            default=10000,
+            type=int,
+            help="Number of delete actions between checkpoints of sorted engine, default: 10000",
+        )
         self.add_argument(
             "-d",
             "--debug",
@@ -191,7 +405,30 @@ class ArgumentParser(_Base):
             action="store_true",
             dest="no_check",
             default=False,
-            help="Disable check & remove if duplicities found after with standard search query",
+            help="""Disable verification (batched mget) that duplicates were
+                          deleted and kept documents remain, duplicates still
+                          present are deleted again""",
+        )
+        self.add_argument(
+            "--check-concurrency",
+            dest="check_concurrency",
+            default=4,
+            type=int,
+            help="Number of concurrent mget requests used for verification and --print-docs, default: 4",
+        )
+        self.add_argument(
+            "--print-docs",
+            dest="print_docs",
+            default=None,
+            help="""In --noop mode fetch documents of duplicate groups and write
+                          them as JSON lines into FILE ('-' for stdout, default with --debug)""",
+            metavar="FILE",
+        )
+        self.add_argument(
+            "--print-fields",
+            dest="print_fields",
+            default=None,
+            help="Comma separated source fields included in --print-docs output, default: whole document",
         )
         self.add_argument(
             "-l",
@@ -210,16 +447,35 @@ class ArgumentParser(_Base):
             "--log_dupl",
             dest="log_dupl",
             default=None,
-            help="File to store duplicates mapping in JSON format",
+            help="File to store duplicates mapping, gzip compressed when ending with .gz",
+        )
+        self.add_argument(
+            "--log-format",
+            dest="log_format",
+            default="json",
+            choices=["json", "ndjson", "binary"],
+            help="Format of --log_dupl mapping, default: json",
         )
         self.add_argument(
             "--log_done",
             dest="log_done",
-            default="es_dedupe.done",
-            help="Logfile containing all document IDs that remained in ES",
+            default=None,
+            help="Logfile containing all document IDs that remained in ES (written by verification)",
+        )
+        self.add_argument(
+            "--check_log",
+            dest="check",
+            help="""Verify mapping saved using --log_dupl against --index:
+                          duplicates have to be deleted, the first document of
+                          every group has to remain""",
         )
         self.add_argument(
-            "--check_log", dest="check", help="Verify that documents has been deleted"
+            "--from-mapping",
+            dest="from_mapping",
+            default=None,
+            help="""Delete duplicates listed in mapping saved using --log_dupl
+                          from --index without scanning it""",
+            metavar="FILE",
         )
         self.add_argument(
             "-n",
@@ -263,6 +519,35 @@ class ArgumentParser(_Base):
             type=int,
             help="Print memory parsing N documents, default: 1000000",
         )
+        self.add_argument(
+            "--metrics-port",
+            dest="metrics_port",
+            default=None,
+            type=int,
+            help="Expose metrics in Prometheus format on http://0.0.0.0:PORT/metrics (JSON on /metrics.json)",
+            metavar="PORT",
+        )
+        self.add_argument(
+            "--metrics-file",
+            dest="metrics_file",
+            default=None,
+            help="Write metrics snapshot as JSON into FILE every --metrics-interval seconds",
+            metavar="FILE",
+        )
+        self.add_argument(
+            "--metrics-interval",
+            dest="metrics_interval",
+            default=10,
+            type=float,
+            help="Seconds between metrics file updates, default: 10",
+        )
+        self.add_argument(
+            "--profile",
+            dest="profile",
+            default=None,
+            help="Profile CPU and memory allocations of scan, detect and delete phases, reports are written into DIR",
+            metavar="DIR",
+        )
         self.add_argument(
             "--no-progress",
             action="store_true",
@@ -13,6 +13,7 @@ from sys import stderr, stdout
 from . import __VERSION__
 from .esdedupe import Esdedupe
 from .cli import ArgumentParser
+from .profiling import Profiler
 
 
 def setup_logging(args, default_log_level=INFO, es_log=WARN):
@@ -65,8 +66,19 @@ def main():
 
     setup_logging(args, loglevel(args.level), loglevel(args.es_level))
     try:
-        dedupe = Esdedupe()
-        dedupe.run(args)
+        if args.use_async:
+            from .aio import AsyncEsdedupe
+
+            dedupe = AsyncEsdedupe()
+        else:
+            dedupe = Esdedupe()
+        if args.profile:
+            dedupe.profiler = Profiler(args.profile)
+        try:
+            dedupe.run(args)
+        finally:
+            if dedupe.profiler is not None:
+                dedupe.profiler.write()
     except KeyboardInterrupt:
         print("Interrupted by Keyboard")
         try:
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+import time
+
+from logging import getLogger
+
+
+# Delete documents using server side _delete_by_query tasks, every task
+# deletes a batch of up to --dbq-batch IDs (`ids` query, slices=auto). Up to
+# --threads tasks run at the same time, they are polled using the Tasks API.
+# Optional --max-rate is split among concurrent tasks (requests_per_second).
+# Results of completed tasks are removed from the `.tasks` index.
+#
+# Deleted counts are documents, unlike bulk deletes replicas aren't counted.
+class DeleteByQuery:
+    MIN_POLL = 0.1
+    MAX_POLL = 5
+
+    def __init__(self, es, args):
+        self.log = getLogger("esdedupe")
+        self.es = es.options(request_timeout=args.request_timeout)
+        self.batch = max(args.dbq_batch, 1)
+        self.concurrency = max(args.threads, 1)
+        self.rps = -1
+        if args.max_rate:
+            self.rps = args.max_rate / self.concurrency
+        self.fail_fast = args.fail_fast
+        self.deleted = 0
+        self.failed = 0
+        self.conflicts = 0
+        self.tasks = 0
+
+    def run(self, actions, progress=None):
+        batches = self._batches(actions)
+        # task ID: number of IDs
+        running = {}
+        poll = self.MIN_POLL
+        while True:
+            while len(running) < self.concurrency:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                index, ids = batch
+                running[self._submit(index, ids)] = len(ids)
+            if not running:
+                break
+            time.sleep(poll)
+            completed = 0
+            for task in list(running):
+                resp = self.es.tasks.get(task_id=task)
+                if resp.get("completed"):
+                    self._forget(task)
+                    self._handle(task, resp, running.pop(task), progress)
+                    completed += 1
+            # long running tasks are polled less often
+            poll = self.MIN_POLL if completed else min(poll * 2, self.MAX_POLL)
+        return self.deleted
+
+    # (index, IDs) batches, actions of different indices are never mixed
+    def _batches(self, actions):
+        index = None
+        ids = []
+        for action in actions:
+            if ids and (action["_index"] != index or len(ids) >= self.batch):
+                yield index, ids
+                ids = []
+            index = action["_index"]
+            ids.append(action["_id"])
+        if ids:
+            yield index, ids
+
+    def _submit(self, index, ids):
+        resp = self.es.delete_by_query(
+            index=index,
+            query={"ids": {"values": ids}},
+            slices="auto",
+            conflicts="proceed",
+            requests_per_second=self.rps,
+            wait_for_completion=False,
+        )
+        self.tasks += 1
+        self.log.debug(
+            "Submitted delete_by_query task {} ({} IDs)".format(resp["task"], len(ids))
+        )
+        return resp["task"]
+
+    # task result stored by wait_for_completion=false isn't needed anymore
+    def _forget(self, task):
+        try:
+            self.es.options(ignore_status=404).delete(index=".tasks", id=task)
+        except Exception as e:
+            self.log.debug("Unable to remove result of task {}: {}".format(task, e))
+
+    def _handle(self, task, resp, count, progress):
+        if "error" in resp:
+            self.failed += count
+            self.log.error("Task {} failed: {}".format(task, resp["error"]))
+            if self.fail_fast:
+                raise RuntimeError("delete_by_query task {} failed".format(task))
+        else:
+            result = resp["response"]
+            self.deleted += result["deleted"]
+            self.conflicts += result.get("version_conflicts", 0)
+            failures = result.get("failures") or []
+            if failures:
+                self.failed += len(failures)
+                self.log.error(
+                    "Task {} finished with {} failures, first: {}".format(
+                        task, len(failures), failures[0]
+                    )
+                )
+                if self.fail_fast:
+                    raise RuntimeError("delete_by_query task {} failed".format(task))
+        if progress is not None:
+            progress.update(count)
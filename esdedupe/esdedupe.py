@@ -2,44 +2,95 @@
 
 # -*- coding: utf-8 -*-
 
-import hashlib
+import collections
+import copy
+import itertools
+import math
+import os
+import queue
+import re
+import threading
 import time
 import tqdm
 import ujson
 import requests
 import sys
 
-from benedict import benedict
-from elasticsearch import Elasticsearch, helpers
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import ScanError
 from elasticsearch.helpers import parallel_bulk
 from elasticsearch.helpers import streaming_bulk
 from logging import getLogger
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 
 from . import __VERSION__
-from .utils import memusage, time_to_sec, to_es_date
+from .adaptive import AdaptiveBulk
+from .bloom import BloomFilter
+from .checkpoint import Checkpoint
+from .dbq import DeleteByQuery
+from .fields import KeyBuilder, hash_size, xxhash_available
+from .keystore import KeyCache, KeyStore
+from .mapping import MappingWriter, read_groups
+from .metrics import Metrics, MetricsExporter, TimedClient
+from .spill import SpillStore
+from .utils import (
+    bytes_fmt,
+    from_es_date,
+    memusage,
+    size_to_bytes,
+    time_to_sec,
+    to_epoch_millis,
+    to_es_date,
+)
 
 
 class Esdedupe:
+    # maximum number of multi-field keys fetched using a single query
+    MAX_KEY_CLAUSES = 256
+    # number of date_histogram buckets used for --window auto
+    HISTOGRAM_BUCKETS = 10000
+
     def __init__(self):
         self.log = getLogger("esdedupe")
         self.total = 0
+        self.checkpoint = None
+        # --lookback key caches by index
+        self.caches = {}
+        self.metrics = Metrics()
+        # size of keys produced by KeyBuilder
+        self.key_size = 16
+        # Profiler set by --profile
+        self.profiler = None
+
+    # time (and with --profile also profile) a phase of processing
+    @contextmanager
+    def phase(self, name):
+        with ExitStack() as stack:
+            stack.enter_context(self.metrics.timed(name))
+            if self.profiler is not None:
+                stack.enter_context(self.profiler.phase(name))
+            yield
 
     # Process documents returned by the current search/scroll
+    # `unique_fields` is a KeyBuilder with precompiled field accessors
     def build_index(self, docs_hash, unique_fields, hit):
-        hashval = None
-        hit_benedict = benedict(hit)
-        _id = hit_benedict["_id"]
-        # there's no need to hash, if we have just single unique key
-        if len(unique_fields) > 1:
-            combined_key = ""
-            for field in unique_fields:
-                combined_key += str(hit_benedict["_source"][field])
-            hashval = hashlib.md5(combined_key.encode("utf-8")).digest()
-        else:
-            hashval = str(hit_benedict["_source"][unique_fields[0]])
+        return docs_hash.add(unique_fields(hit), hit["_id"])
 
-        docs_hash.setdefault(hashval, []).append(_id)
+    # Documents mapping, either in memory or spilling to disk when
+    # --spill-memory budget is given
+    def new_store(self, args):
+        if args.online:
+            # the first occurrence is kept, IDs of later ones are not needed
+            return KeyStore(key_size=self.key_size, ids=False)
+        if args.spill_memory:
+            return SpillStore(
+                size_to_bytes(args.spill_memory),
+                key_size=self.key_size,
+                directory=args.spill_dir,
+            )
+        return KeyStore(key_size=self.key_size)
 
     def elastic_uri(self, args):
         if args.host.startswith("http"):
@@ -89,9 +140,19 @@ class Esdedupe:
             sys.exit(1)
         return
 
+    # arguments shared by sync and async Elasticsearch clients
+    def client_kwargs(self, args):
+        kwargs = {
+            "hosts": [self.elastic_uri(args)],
+            "verify_certs": args.cert_verify,
+            "ssl_show_warn": args.cert_verify,
+        }
+        if args.user:
+            kwargs["basic_auth"] = (args.user, args.password)
+        return kwargs
+
     def run(self, args):
         start = time.time()
-        uri = self.elastic_uri(args)
         self.log.info(
             "Starting esdedupe: {} - duplicate document removal tool".format(
                 __VERSION__
@@ -99,22 +160,83 @@ class Esdedupe:
         )
         if args.noop:
             self.log.info("Running in NOOP mode, no document will be deleted.")
+        if args.online and (args.engine != "scan" or args.spill_memory):
+            self.log.error("--online mode requires scan engine without --spill-memory")
+            sys.exit(1)
+        if args.online and args.log_dupl:
+            self.log.warning(
+                "--online mode doesn't keep mapping, --log_dupl is ignored"
+            )
+            args.log_dupl = None
+        if args.engine == "sorted":
+            for option, value in (
+                ("--log_dupl", args.log_dupl),
+                ("--print-docs", args.print_docs),
+            ):
+                if value:
+                    self.log.warning(
+                        "--engine sorted doesn't keep mapping, {} is ignored".format(
+                            option
+                        )
+                    )
+            args.log_dupl = None
+            args.print_docs = None
+            if args.scan_slices > 1:
+                self.log.warning(
+                    "--engine sorted reads a single sorted stream, --scan-slices is ignored"
+                )
+                args.scan_slices = 1
+        if args.lookback and (
+            not args.window
+            or args.engine != "scan"
+            or args.online
+            or args.spill_memory
+            or args.window_concurrency > 1
+        ):
+            self.log.error(
+                "--lookback requires --window, scan engine without --online and --spill-memory and sequential windows"
+            )
+            sys.exit(1)
+        if args.key_hash == "xxhash" and not xxhash_available():
+            self.log.error(
+                "--key-hash xxhash requires xxhash, install it using: pip install xxhash"
+            )
+            sys.exit(1)
         try:
-            # test connection to Elasticsearch cluster first
-            self.ping(args)
-            if args.user:
-                es = Elasticsearch(
-                    [uri],
-                    basic_auth=(args.user, args.password),
-                    verify_certs=args.cert_verify,
-                    ssl_show_warn=args.cert_verify,
+            hash_size(args.key_hash, args.key_size)
+        except ValueError as e:
+            self.log.error(e)
+            sys.exit(1)
+        if args.prefilter and (args.engine != "scan" or args.online):
+            self.log.error("--prefilter requires scan engine without --online")
+            sys.exit(1)
+        if args.checkpoint:
+            if args.noop:
+                self.log.warning(
+                    "Nothing is deleted in NOOP mode, --checkpoint is ignored"
                 )
             else:
-                es = Elasticsearch(
-                    hosts=[uri],
-                    verify_certs=args.cert_verify,
-                    ssl_show_warn=args.cert_verify,
-                )
+                try:
+                    self.checkpoint = Checkpoint(args.checkpoint, args.field)
+                except ValueError as e:
+                    self.log.error(e)
+                    sys.exit(1)
+                self.log.info("Using checkpoint file {}".format(args.checkpoint))
+        exporter = None
+        if args.metrics_port or args.metrics_file:
+            exporter = MetricsExporter(
+                self.metrics,
+                args.metrics_port,
+                args.metrics_file,
+                args.metrics_interval,
+            )
+            exporter.start()
+        try:
+            # test connection to Elasticsearch cluster first
+            self.ping(args)
+            es = Elasticsearch(**self.client_kwargs(args))
+            if exporter is not None:
+                es = TimedClient(es, self.metrics)
 
             resp = es.info()
             self.log.info(
@@ -123,18 +245,59 @@ class Esdedupe:
                 )
             )
 
-            docs = {}
-            dupl = 0
-
             # one or more fields to form a unique key (primary key)
-            pk = args.field.split(",")
-            self.log.info("Unique fields: {}".format(pk))
+            fetch = args.fetch
+            if args.engine in ("composite", "sorted") and fetch != "docvalue":
+                # aggregated and sort fields have doc values, while `_source`
+                # doesn't contain sub-fields like `name.keyword`
+                self.log.info(
+                    "--engine {} reads unique fields from doc values".format(
+                        args.engine
+                    )
+                )
+                fetch = "docvalue"
+            pk = KeyBuilder(
+                args.field.split(","),
+                fetch,
+                args.key_hash,
+                args.key_size,
+                args.key_separator,
+            )
+            self.key_size = pk.key_size
+            self.log.info(
+                "Unique fields: {}, fetched from: {}, key: {} ({} bytes)".format(
+                    pk.fields, pk.fetch, pk.hash, pk.key_size
+                )
+            )
 
-            if args.index != "":
+            if args.check:
+                if args.index == "":
+                    self.log.error(
+                        "Please specify --index to verify --check_log against"
+                    )
+                    sys.exit(1)
+                if not self.check_log(es, args):
+                    sys.exit(1)
+                return
+            if args.from_mapping:
+                if args.index == "":
+                    self.log.error(
+                        "Please specify --index to delete --from-mapping documents from"
+                    )
+                    sys.exit(1)
+                self.total = self.replay(es, args)
+            elif args.index != "":
                 index = args.index
                 # if indexname specifically was set, do not do --all mode
                 args.all = False
-                self.process_index(es, docs, pk, dupl, index, args)
+                docs = self.new_store(args)
+                self.total = self.process_index(es, docs, pk, 0, index, args)
+            elif args.all:
+                indices = self.resolve_indices(es, args)
+                self.total = self.process_indices(es, pk, indices, args)
+            else:
+                self.log.error("Please specify --index or --all")
+                sys.exit(1)
 
             end = time.time()
             if args.noop:
@@ -144,7 +307,7 @@ class Esdedupe:
                     )
                 )
             else:
-                if dupl > 0:
+                if self.total > 0:
                     self.log.info(
                         """Successfully completed duplicates removal.
                                   Took: {0}""".format(timedelta(seconds=(end - start)))
@@ -156,8 +319,100 @@ class Esdedupe:
 
         except ConnectionError as e:
             self.log.error(e)
+        finally:
+            if exporter is not None:
+                exporter.stop()
+
+    # Open indices matching --prefix (all indices by default), without those
+    # matching --indexexclude regexp, sorted according to --index-order.
+    # Closed indices can't be scanned, hidden and system indices (`.kibana`,
+    # `.security`, ...) are never expanded from a wildcard.
+    def resolve_indices(self, es, args):
+        if args.prefix == "*":
+            pattern = "*"
+        else:
+            pattern = "{}{}*".format(args.prefix, args.prefixseparator)
+        rows = es.cat.indices(
+            index=pattern,
+            format="json",
+            bytes="b",
+            expand_wildcards="open",
+            h="index,status,docs.count,store.size,creation.date",
+        )
+        # older clusters expand dot-prefixed indices even when not hidden
+        rows = [
+            row
+            for row in rows
+            if row.get("status", "open") == "open"
+            and (not row["index"].startswith(".") or pattern.startswith("."))
+        ]
+        if args.indexexclude:
+            exclude = re.compile(args.indexexclude)
+            rows = [row for row in rows if not exclude.search(row["index"])]
+        if args.index_order == "size":
+            # largest first, keeps concurrent workers busy till the end
+            rows.sort(key=lambda row: int(row.get("store.size") or 0), reverse=True)
+        elif args.index_order == "date":
+            rows.sort(key=lambda row: int(row.get("creation.date") or 0))
+        else:
+            rows.sort(key=lambda row: row["index"])
+        indices = [row["index"] for row in rows]
+        self.log.info(
+            "Matched {} indices using pattern '{}': {}".format(
+                len(indices), pattern, ", ".join(indices)
+            )
+        )
+        return indices
+
+    # Process given indices, up to --index-concurrency at the same time.
+    # Every index has its own mapping and copy of arguments.
+    def process_indices(self, es, pk, indices, args):
+        def process(index):
+            # process_index modifies time range of its arguments
+            index_args = copy.copy(args)
+            return self.process_index(
+                es, self.new_store(index_args), pk, 0, index, index_args
+            )
+
+        total = 0
+        done = 0
+        failed = []
+        with ThreadPoolExecutor(
+            max_workers=max(args.index_concurrency, 1), thread_name_prefix="index"
+        ) as pool:
+            futures = {pool.submit(process, index): index for index in indices}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    removed = future.result()
+                except Exception as e:
+                    if args.fail_fast:
+                        for f in futures:
+                            f.cancel()
+                        raise
+                    self.log.error("Processing index {} failed: {}".format(index, e))
+                    failed.append(index)
+                    continue
+                total += removed
+                done += 1
+                self.log.info(
+                    "Finished index {}, removed: {:0,} ({}/{} indices done)".format(
+                        index, removed, done, len(indices)
+                    )
+                )
+        if failed:
+            self.log.error("Failed indices: {}".format(", ".join(failed)))
+        return total
 
     def process_index(self, es, docs, pk, dupl, index, args):
+        if self.checkpoint is not None and self.checkpoint.index_done(index):
+            self.log.info(
+                "Index {} has been already processed according to checkpoint ({:0,} documents removed), skipping".format(
+                    index, self.checkpoint.removed(index)
+                )
+            )
+            return 0
+        total = 0
         if args.window:
             if not args.timestamp:
                 self.log.error("Please specify --timestamp field")
@@ -173,109 +428,743 @@ class Esdedupe:
                 )
                 sys.exit(1)
 
-            win = time_to_sec(args.window)
             self.log.info(
                 "Timestamp based search, with window {} from {} until {}".format(
                     args.window, args.since, args.until
                 )
             )
+            if args.window == "auto":
+                planned = self.planned_windows(es, index, args)
+            else:
+                planned = self.windows(args.since, args.until, time_to_sec(args.window))
 
-            end = args.until
-
-            currStart = args.since
-            currEnd = args.since + timedelta(seconds=win)
-            self.total = 0
-            # scan & remove using sliding window
-            while currEnd < end:
-                docs = {}  # avoid deleting same documents again and again
+            # every window gets its own mapping
+            docs.close()
+            windows = []
+            for since, until in planned:
+                window = Checkpoint.window_key(to_es_date(since), to_es_date(until))
+                if self.checkpoint is not None and self.checkpoint.window_done(
+                    index, window
+                ):
+                    self.log.info(
+                        "Skipping window from: {} until: {}, already completed".format(
+                            to_es_date(since), to_es_date(until)
+                        )
+                    )
+                    continue
+                windows.append((since, until, window))
+            if self.checkpoint is not None and self.checkpoint.removed(index):
                 self.log.info(
-                    "Using window {}, from: {} until: {}".format(
-                        args.window, to_es_date(currStart), to_es_date(currEnd)
+                    "Resuming index {}, {:0,} documents removed by previous runs".format(
+                        index, self.checkpoint.removed(index)
                     )
                 )
-                args.since = currStart
-                args.until = currEnd
-                self.total += self.scan_and_remove(es, docs, pk, dupl, index, args)
-                currStart += timedelta(seconds=win)
-                currEnd += timedelta(seconds=win)
 
-            if currEnd != end:
+            if args.lookback:
+                self.caches[index] = KeyCache(time_to_sec(args.lookback) * 1000)
+            # scan & remove using sliding window
+            for num, removed in enumerate(
+                self.process_windows(es, pk, dupl, index, windows, args)
+            ):
+                since, until, window = windows[num]
                 self.log.info(
-                    "Last check, from: {} until: {}".format(
-                        to_es_date(currStart), to_es_date(end)
+                    "Finished window {}/{}, from: {} until: {}, removed: {:0,}".format(
+                        num + 1,
+                        len(windows),
+                        to_es_date(since),
+                        to_es_date(until),
+                        removed,
                     )
                 )
-                args.since = currStart
-                args.until = end
-                self.total += self.scan_and_remove(es, docs, pk, dupl, index, args)
+                total += removed
+            self.caches.pop(index, None)
+            if self.checkpoint is not None:
+                self.checkpoint.complete_index(index)
         else:
             # "normal" index without timestamps
-            self.total += self.scan_and_remove(es, docs, pk, dupl, index, args)
+            total += self.scan_and_remove(es, docs, pk, dupl, index, args)
+            if self.checkpoint is not None:
+                self.checkpoint.complete_index(index, total)
         self.log.info(
-            "Altogether {} documents were removed (including doc replicas)".format(
-                self.total
+            "Altogether {} documents were removed from {} ({})".format(
+                total, index, self.removed_note(args)
             )
         )
+        return total
+
+    # bulk deletes count shard copies, delete_by_query tasks only documents
+    def removed_note(self, args):
+        if args.delete_engine == "dbq":
+            return "replicas not counted"
+        return "including doc replicas"
 
-    def scan(self, es, docs_hash, unique_fields, index, args):
+    # Windows for --window auto, plan is stored in checkpoint, deleting
+    # documents changes the histogram and thus the windows
+    def planned_windows(self, es, index, args):
+        if self.checkpoint is not None:
+            plan = self.checkpoint.plan(index)
+            if plan is not None:
+                self.log.info(
+                    "Using {} windows planned by previous run".format(len(plan))
+                )
+                return [
+                    (from_es_date(since), from_es_date(until)) for since, until in plan
+                ]
+        windows = list(self.auto_windows(es, index, args))
+        self.log.info(
+            "Split into {} windows targeting {:0,} documents each".format(
+                len(windows), args.window_docs
+            )
+        )
+        if self.checkpoint is not None:
+            self.checkpoint.save_plan(
+                index,
+                [[to_es_date(since), to_es_date(until)] for since, until in windows],
+            )
+        return windows
+
+    # Variable width windows holding roughly --window-docs documents each,
+    # boundaries are taken from date_histogram of --timestamp field. A bucket
+    # with more documents than the target forms a window on its own.
+    def auto_windows(self, es, index, args):
+        span = (args.until - args.since).total_seconds()
+        interval = max(int(math.ceil(span / self.HISTOGRAM_BUCKETS)), 1)
+        histogram = {
+            "date_histogram": {
+                "field": args.timestamp,
+                "fixed_interval": "{}s".format(interval),
+                "min_doc_count": 1,
+            }
+        }
+        resp = es.options(request_timeout=args.request_timeout).search(
+            index=index, size=0, aggs={"histogram": histogram}, **self.es_query(args)
+        )
+        start = args.since
+        docs = 0
+        for bucket in resp["aggregations"]["histogram"]["buckets"]:
+            # bucket keys are UTC epoch millis, our dates are naive UTC
+            key = datetime.fromtimestamp(bucket["key"] / 1000, timezone.utc).replace(
+                tzinfo=None
+            )
+            if docs and docs + bucket["doc_count"] > args.window_docs and key > start:
+                yield start, key
+                start = key
+                docs = 0
+            docs += bucket["doc_count"]
+        yield start, args.until
+
+    # Process windows, up to --window-concurrency at the same time, yields
+    # numbers of removed documents in the same order as `windows`
+    def process_windows(self, es, pk, dupl, index, windows, args):
+        concurrency = max(args.window_concurrency, 1)
+        if concurrency == 1:
+            for since, until, window in windows:
+                yield self.process_window(
+                    es, pk, dupl, index, since, until, window, args
+                )
+            return
+        window_args = copy.copy(args)
+        if args.spill_memory:
+            # --spill-memory is a global cap, split among concurrent windows
+            budget = size_to_bytes(args.spill_memory) // concurrency
+            window_args.spill_memory = str(budget)
+        with ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="window"
+        ) as pool:
+            futures = [
+                pool.submit(
+                    self.process_window,
+                    es,
+                    pk,
+                    dupl,
+                    index,
+                    since,
+                    until,
+                    window,
+                    window_args,
+                )
+                for since, until, window in windows
+            ]
+            try:
+                for future in futures:
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    # Scan & remove documents within [since, until), every window has its own
+    # mapping and copy of arguments
+    def process_window(self, es, pk, dupl, index, since, until, window, args):
+        args = copy.copy(args)
+        args.since = since
+        args.until = until
+        self.log.info(
+            "Using window {}, from: {} until: {}".format(
+                args.window, to_es_date(since), to_es_date(until)
+            )
+        )
+        cache = self.caches.get(index)
+        if cache is not None:
+            cache.start(to_epoch_millis(since), to_epoch_millis(until))
+        # avoid deleting same documents again and again
+        docs = self.new_store(args)
+        removed = self.scan_and_remove(es, docs, pk, dupl, index, args, window)
+        if self.checkpoint is not None:
+            self.checkpoint.complete_window(index, window, removed)
+        return removed
+
+    # Split [since, until) into consecutive windows of `win` seconds, the last
+    # one might be shorter
+    def windows(self, since, until, win):
+        step = timedelta(seconds=win)
+        while since < until:
+            yield since, min(since + step, until)
+            since += step
+
+    # `on_duplicate` is called with every hit whose key has been seen before
+    def scan(self, es, docs_hash, unique_fields, index, args, on_duplicate=None):
         i = 0
         self.log.info(
-            "Building documents mapping on index: {}, batch size: {}".format(
-                index, args.batch
+            "Building documents mapping on index: {}, batch size: {}, slices: {}".format(
+                index, args.batch, args.scan_slices
             )
         )
-        for hit in helpers.scan(
-            es,
-            index=index,
-            size=args.batch,
-            query=self.es_query(args),
-            scroll=args.scroll,
-            request_timeout=args.request_timeout,
-        ):
-            self.build_index(docs_hash, unique_fields, hit)
+        query = self.es_query(args, unique_fields)
+        cache = self.caches.get(index)
+        for hit in self.hits(es, index, query, args):
+            if not self.build_index(docs_hash, unique_fields, hit) and on_duplicate:
+                on_duplicate(hit)
+            if cache is not None:
+                self.remember(cache, unique_fields, hit, args)
+            i += 1
+            if i % args.mem_report == 0:
+                self.metrics.mapping(docs_hash)
+                self.log.debug(
+                    "Scanned {:0,} documents, mapping size: {}, memory usage: {}".format(
+                        docs_hash.docs, bytes_fmt(docs_hash.nbytes()), memusage()
+                    )
+                )
+        dupl = self.count_duplicates(docs_hash)
+        self.metrics.mapping(docs_hash, len(docs_hash))
+        return dupl
+
+    # Two passes over the index: keys of all documents are fed into a Bloom
+    # filter sized from document count first, keys reported as already seen
+    # are candidate duplicates (every real duplicate plus a few false
+    # positives). The second pass stores IDs of candidate documents only.
+    def prefiltered_scan(self, es, docs_hash, unique_fields, index, args):
+        query = self.es_query(args, unique_fields)
+        count_query = {"query": query["query"]} if "query" in query else {}
+        count = es.count(index=index, **count_query)["count"]
+        bloom = BloomFilter(count, args.prefilter_error)
+        # keys of documents from previous window are needed as well
+        cache = self.caches.get(index)
+        seen = cache if cache is not None else ()
+        candidates = KeyStore(key_size=self.key_size, ids=False)
+        self.log.info(
+            "Pass 1/2: collecting candidate keys of {:0,} documents on index: {}, Bloom filter: {} ({} hashes)".format(
+                count, index, bytes_fmt(bloom.nbytes()), bloom.hashes
+            )
+        )
+        for hit in self.hits(es, index, query, args):
+            key = unique_fields(hit)
+            if bloom.add(key) or key in seen:
+                candidates.add(key, None)
+        self.log.info(
+            "Found {:0,} candidate keys, memory usage: {}".format(
+                len(candidates), memusage()
+            )
+        )
+        bloom = None
+        self.log.info(
+            "Pass 2/2: building documents mapping of candidates on index: {}".format(
+                index
+            )
+        )
+        i = 0
+        for hit in self.hits(es, index, query, args):
+            key = unique_fields(hit)
+            if key in candidates:
+                docs_hash.add(key, hit["_id"])
+            if cache is not None:
+                self.remember(cache, unique_fields, hit, args)
             i += 1
             if i % args.mem_report == 0:
+                self.metrics.mapping(docs_hash)
                 self.log.debug(
-                    "Scanned {:0,} unique documents, memory usage: {}".format(
-                        len(docs_hash), memusage()
+                    "Scanned {:0,} documents, mapping size: {}, memory usage: {}".format(
+                        i, bytes_fmt(docs_hash.nbytes()), memusage()
                     )
                 )
+        dupl = self.count_duplicates(docs_hash)
+        self.metrics.mapping(docs_hash, len(docs_hash))
+        return dupl
+
+    # keys of documents close to the end of window are checked in the next one
+    def remember(self, cache, unique_fields, hit, args):
+        ts = int(float(hit["fields"][args.timestamp][0]))
+        if ts >= cache.tail:
+            cache.remember(unique_fields(hit), ts)
+
+    # number of mapping keys seen in previous window, every document with
+    # such key is a duplicate
+    def carried_keys(self, docs_hash, index):
+        cache = self.caches.get(index)
+        if cache is None:
+            return 0
+        return sum([1 for key in cache if key in docs_hash])
+
+    # Iterate over all documents matching the query, with --scan-slices > 1
+    # the index is read by concurrent workers using sliced scroll
+    def hits(self, es, index, query, args):
+        if args.scan_slices > 1:
+            pages = self.sliced_pages(es, index, query, args)
+        else:
+            pages = self.scroll_pages(es, index, query, args)
+        for page in pages:
+            yield from page
+
+    # Scroll search results page by page, clears scroll context when done
+    def scroll_pages(self, es, index, query, args):
+        client = es.options(request_timeout=args.request_timeout)
+        start = time.time()
+        resp = client.search(index=index, scroll=args.scroll, size=args.batch, **query)
+        scroll_id = resp.get("_scroll_id")
+        try:
+            while scroll_id and resp["hits"]["hits"]:
+                self.page_metrics(start, resp)
+                shards = resp["_shards"]
+                succeeded = shards.get("successful", 0) + shards.get("skipped", 0)
+                if succeeded < shards.get("total", 0):
+                    raise ScanError(
+                        scroll_id,
+                        "Scroll request has only succeeded on {} shards out of {}".format(
+                            succeeded, shards["total"]
+                        ),
+                    )
+                yield resp["hits"]["hits"]
+                start = time.time()
+                resp = client.scroll(scroll_id=scroll_id, scroll=args.scroll)
+                scroll_id = resp.get("_scroll_id")
+        finally:
+            if scroll_id:
+                es.options(ignore_status=404).clear_scroll(scroll_id=scroll_id)
+
+    def page_metrics(self, start, resp):
+        self.metrics.observe("esdedupe_scroll_page_seconds", time.time() - start)
+        self.metrics.inc("esdedupe_docs_scanned_total", len(resp["hits"]["hits"]))
+
+    # Read all slices concurrently, pages are handed over to the calling
+    # thread, which is the only one modifying the documents mapping
+    def sliced_pages(self, es, index, query, args):
+        slices = args.scan_slices
+        pages = queue.Queue(maxsize=slices * 2)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker(slice_id):
+            sliced = dict(query, slice={"id": slice_id, "max": slices})
+            # closing the generator clears the scroll context right away
+            scroll = self.scroll_pages(es, index, sliced, args)
+            try:
+                for page in scroll:
+                    if not put((slice_id, page)):
+                        return
+                put((slice_id, None))
+            except Exception as e:
+                put((slice_id, e))
+            finally:
+                scroll.close()
+
+        workers = [
+            threading.Thread(
+                target=worker,
+                args=(slice_id,),
+                name="slice-{}".format(slice_id),
+                daemon=True,
+            )
+            for slice_id in range(slices)
+        ]
+        for thread in workers:
+            thread.start()
+
+        start = time.time()
+        counts = [0] * slices
+        total = 0
+        running = slices
+        try:
+            while running > 0:
+                slice_id, page = pages.get()
+                if page is None:
+                    running -= 1
+                    self.log.info(
+                        "Slice {}/{} finished, {:0,} documents, took: {}".format(
+                            slice_id + 1,
+                            slices,
+                            counts[slice_id],
+                            timedelta(seconds=(time.time() - start)),
+                        )
+                    )
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    counts[slice_id] += len(page)
+                    total += len(page)
+                    if (
+                        total // args.mem_report
+                        > (total - len(page)) // args.mem_report
+                    ):
+                        self.log.debug(
+                            "Scanned {:0,} documents, per slice: {}, memory usage: {}".format(
+                                total, counts, memusage()
+                            )
+                        )
+                    yield page
+        finally:
+            stop.set()
+            # unfinished workers notice within a second (or once their
+            # current request completes)
+            for thread in workers:
+                thread.join()
+
+    # Find duplicate keys server-side using composite aggregation, afterwards
+    # only documents sharing their key with another document are fetched
+    def composite_scan(self, es, docs_hash, unique_fields, index, args):
+        fields = unique_fields.es_fields()
+        self.log.info(
+            "Aggregating keys on index: {}, fields: {}, page size: {}".format(
+                index, fields, args.batch
+            )
+        )
+        # keep number of boolean clauses in a single query reasonable
+        limit = (
+            args.batch if len(fields) == 1 else min(args.batch, self.MAX_KEY_CLAUSES)
+        )
+        keys = []
+        for key in self.duplicate_buckets(es, fields, index, args):
+            keys.append(key)
+            if len(keys) >= limit:
+                self.fetch_keys(es, docs_hash, unique_fields, keys, index, args)
+                keys = []
+        if keys:
+            self.fetch_keys(es, docs_hash, unique_fields, keys, index, args)
         return self.count_duplicates(docs_hash)
 
-    def scan_and_remove(self, es, docs_hash, unique_fields, dupl, index, args):
-        # find duplicate documents
-        dupl = self.scan(es, docs_hash, unique_fields, index, args)
-        if dupl == 0:
+    # Page through composite aggregation on unique fields, yields keys of
+    # buckets containing more than one document
+    def duplicate_buckets(self, es, fields, index, args):
+        client = es.options(request_timeout=args.request_timeout)
+        query = self.es_query(args)
+        composite = {
+            "size": args.batch,
+            "sources": [{field: {"terms": {"field": field}}} for field in fields],
+        }
+        docs = 0
+        keys = 0
+        dupl_keys = 0
+        while True:
+            resp = client.search(
+                index=index, size=0, aggs={"keys": {"composite": composite}}, **query
+            )
+            agg = resp["aggregations"]["keys"]
+            for bucket in agg["buckets"]:
+                keys += 1
+                docs += bucket["doc_count"]
+                if bucket["doc_count"] > 1:
+                    dupl_keys += 1
+                    yield bucket["key"]
+            if not agg["buckets"] or "after_key" not in agg:
+                break
+            composite["after"] = agg["after_key"]
+        self.log.info(
+            "Aggregated {:0,} documents into {:0,} keys, keys with duplicates: {:0,}".format(
+                docs, keys, dupl_keys
+            )
+        )
+
+    # Fetch documents matching given composite keys into the mapping
+    def fetch_keys(self, es, docs_hash, unique_fields, keys, index, args):
+        fields = unique_fields.es_fields()
+        if len(fields) == 1:
+            match = {"terms": {fields[0]: [key[fields[0]] for key in keys]}}
+        else:
+            match = {
+                "bool": {
+                    "should": [
+                        {"bool": {"filter": [{"term": {f: key[f]}} for f in fields]}}
+                        for key in keys
+                    ],
+                    "minimum_should_match": 1,
+                }
+            }
+        query = self.es_query(args, unique_fields)
+        filters = [match]
+        if "query" in query:
+            filters.append(query["query"])
+        query["query"] = {"bool": {"filter": filters}}
+        for hit in self.hits(es, index, query, args):
+            self.build_index(docs_hash, unique_fields, hit)
+
+    # Iterate over documents sorted by unique fields using point in time
+    # and search_after, documents sharing a key are always adjacent
+    def sorted_pages(self, es, index, unique_fields, args, search_after=None):
+        client = es.options(request_timeout=args.request_timeout)
+        pit = client.open_point_in_time(index=index, keep_alive=args.scroll)["id"]
+        query = self.es_query(args, unique_fields)
+        # _shard_doc is the most efficient tiebreaker within a point in time
+        query["sort"] = [{f: "asc"} for f in unique_fields.es_fields()]
+        query["sort"].append({"_shard_doc": "asc"})
+        if search_after is not None:
+            query["search_after"] = search_after
+        try:
+            while True:
+                query["pit"] = {"id": pit, "keep_alive": args.scroll}
+                start = time.time()
+                resp = client.search(size=args.batch, **query)
+                hits = resp["hits"]["hits"]
+                if not hits:
+                    break
+                self.page_metrics(start, resp)
+                pit = resp.get("pit_id", pit)
+                yield hits
+                query["search_after"] = hits[-1]["sort"]
+        finally:
+            es.options(ignore_status=404).close_point_in_time(id=pit)
+
+    # Stream delete action for every document having the same key as the
+    # previous one, `stats` are updated while the stream is being consumed.
+    # Resuming from checkpoint `position` starts with the first document of
+    # the last processed key. _shard_doc values are valid only within a point
+    # in time, the group is read again from its beginning and its first
+    # remaining document is kept.
+    def sorted_delete_iterator(
+        self, es, unique_fields, index, args, stats, position=None
+    ):
+        prev = None
+        search_after = None
+        if position is not None:
+            search_after = position["search_after"][:-1] + [-1]
+        for page in self.sorted_pages(es, index, unique_fields, args, search_after):
+            for hit in page:
+                stats["docs"] += 1
+                stats["sort"] = hit["sort"]
+                key = unique_fields(hit)
+                if key != prev:
+                    prev = key
+                    continue
+                stats["duplicates"] += 1
+                yield self.delete_action(hit["_index"], hit["_id"], args)
+
+    # Constant memory deduplication, no mapping is built at all, deletes are
+    # sent while documents are still being read
+    def sorted_remove(self, es, unique_fields, index, args, window=None):
+        self.log.info(
+            "Streaming documents sorted by {} on index: {}, batch size: {}".format(
+                unique_fields.fields, index, args.batch
+            )
+        )
+        stats = {"docs": 0, "duplicates": 0}
+        position = None
+        if self.checkpoint is not None:
+            position = self.checkpoint.position(index, window)
+        if position is not None:
+            self.log.info(
+                "Resuming from {} ({:0,} documents removed before)".format(
+                    position["search_after"][:-1], position["removed"]
+                )
+            )
+        actions = self.sorted_delete_iterator(
+            es, unique_fields, index, args, stats, position
+        )
+        removed = 0
+        if args.noop:
+            for action in actions:
+                self.log.debug("Duplicate document: {}".format(action["_id"]))
+        elif self.checkpoint is not None:
+            removed = self.checkpointed_delete(
+                actions, es, index, window, position, stats, args
+            )
+        else:
+            removed = self.bulk_delete(actions, es, args)
+        if stats["duplicates"] == 0:
             self.log.info("No duplicates found")
         else:
-            self.total = len(docs_hash)
             self.log.info(
-                "Found {:0,} duplicates out of {:0,} docs, unique documents: {:0,} ({:.1f}% duplicates)".format(
-                    dupl,
-                    dupl + self.total,
-                    self.total,
-                    dupl / (dupl + self.total) * 100,
+                "Found {:0,} duplicates out of {:0,} docs ({:.1f}% duplicates)".format(
+                    stats["duplicates"],
+                    stats["docs"],
+                    stats["duplicates"] / stats["docs"] * 100,
                 )
             )
+        return removed
 
-            if args.log_dupl:
-                self.save_documents_mapping(docs_hash, args)
+    # Send deletes in batches of --checkpoint-interval actions, once a batch
+    # is acknowledged the position of its last document is saved. Returns
+    # number of removed documents, including those removed before resume.
+    def checkpointed_delete(self, actions, es, index, window, position, stats, args):
+        removed = 0
+        if position is not None:
+            removed = position["removed"]
+        # single progress bar for all batches of the window
+        progress = self.progress_bar(args)
+        while True:
+            batch = list(itertools.islice(actions, args.checkpoint_interval))
+            if not batch:
+                return removed
+            removed += self.bulk_delete(batch, es, args, progress=progress)
+            # generator is paused right after yielding the last action
+            self.checkpoint.advance(
+                index, window, {"search_after": stats["sort"], "removed": removed}
+            )
+
+    # Delete documents while scanning, every later occurrence of an already
+    # seen key is queued for deletion right away. The bounded queue applies
+    # back-pressure on scanning when deleting can't keep up.
+    def online_remove(self, es, docs_hash, unique_fields, index, args):
+        self.log.info(
+            "Online mode, duplicates are deleted while scanning, queue size: {}".format(
+                args.online_queue
+            )
+        )
+        actions = queue.Queue(maxsize=args.online_queue)
+        done = object()
+        result = {"removed": 0}
+
+        def consumer():
+            result["removed"] = self.bulk_delete(iter(actions.get, done), es, args)
+
+        worker = threading.Thread(target=consumer, daemon=True)
+
+        def enqueue(item):
+            while True:
+                try:
+                    actions.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    if not worker.is_alive():
+                        raise RuntimeError("Delete worker terminated unexpectedly")
+
+        def on_duplicate(hit):
             if args.noop:
+                self.log.debug("Duplicate document: {}".format(hit["_id"]))
+            else:
+                enqueue(self.delete_action(hit["_index"], hit["_id"], args))
+
+        if not args.noop:
+            worker.start()
+        try:
+            dupl = self.scan(es, docs_hash, unique_fields, index, args, on_duplicate)
+        finally:
+            if worker.is_alive():
+                enqueue(done)
+                worker.join()
+        if dupl == 0:
+            self.log.info("No duplicates found")
+        else:
+            self.log.info(
+                "Found {:0,} duplicates out of {:0,} docs ({:.1f}% duplicates)".format(
+                    dupl, docs_hash.docs, dupl / docs_hash.docs * 100
+                )
+            )
+        return result["removed"]
+
+    def scan_and_remove(
+        self, es, docs_hash, unique_fields, dupl, index, args, window=None
+    ):
+        try:
+            return self.detect_and_remove(
+                es, docs_hash, unique_fields, dupl, index, args, window
+            )
+        finally:
+            # release temporary files of disk based mapping
+            docs_hash.close()
+
+    # `window` identifies checkpoint position, only the sorted engine is able
+    # to resume within a window, other engines scan the whole window again
+    def detect_and_remove(
+        self, es, docs_hash, unique_fields, dupl, index, args, window=None
+    ):
+        if args.engine == "sorted":
+            with self.phase("sorted"):
+                return self.sorted_remove(es, unique_fields, index, args, window)
+        if args.online:
+            with self.phase("online"):
+                return self.online_remove(es, docs_hash, unique_fields, index, args)
+        # find duplicate documents
+        with self.phase("scan"):
+            dupl = self.detect(es, docs_hash, unique_fields, index, args)
+        with self.phase("detect"):
+            carried = self.carried_keys(docs_hash, index)
+            if carried:
+                self.log.info(
+                    "{:0,} keys have been already seen in previous window".format(
+                        carried
+                    )
+                )
+                dupl += carried
+            self.metrics.inc("esdedupe_duplicates_total", dupl)
+            if dupl == 0:
+                self.log.info("No duplicates found")
+                return 0
+            if args.engine == "composite" or args.prefilter:
+                # mapping contains only documents with (candidate) duplicates,
+                # prefilter false positives are keys with a single document
+                groups = sum(1 for _ in docs_hash.duplicate_groups())
                 self.log.info(
-                    """In order to print matching IDs to stdout run with
-                              --debug flag or save results to JSON file using --log_dupl docs.json"""
+                    "Found {:0,} duplicates in {:0,} groups".format(dupl, groups)
                 )
-                if args.debug:
-                    self.print_duplicates(docs_hash, index, es, args)
             else:
-                if args.threads > 1:
-                    return self.parallel_delete(docs_hash, index, es, args, dupl)
-                else:
-                    # safer option, should avoid overloading elastic
-                    return self.sequential_delete(docs_hash, index, es, args, dupl)
+                unique = len(docs_hash) - carried
+                self.log.info(
+                    "Found {:0,} duplicates out of {:0,} docs, unique documents: {:0,} ({:.1f}% duplicates)".format(
+                        dupl,
+                        dupl + unique,
+                        unique,
+                        dupl / (dupl + unique) * 100,
+                    )
+                )
+
+        if args.log_dupl:
+            self.save_documents_mapping(
+                docs_hash, index, self.mapping_path(args, index, window), args
+            )
+        if args.noop:
+            if args.debug or args.print_docs:
+                self.print_duplicates(docs_hash, index, es, args)
+            elif not args.log_dupl:
+                self.log.info(
+                    """In order to print matching documents run with
+                          --print-docs FILE (or --debug for stdout) or save results to JSON file using --log_dupl docs.json"""
+                )
+        else:
+            with self.phase("delete"):
+                removed = self.bulk_delete(
+                    self.delete_iterator(docs_hash, index, args), es, args, dupl
+                )
+            if not args.no_check:
+                with self.phase("verify"):
+                    removed += self.check_removed(docs_hash, index, es, args)
+            return removed
         return 0
 
-    def es_query(self, args):
+    # Fill documents mapping, returns number of duplicates
+    def detect(self, es, docs_hash, unique_fields, index, args):
+        if args.engine == "composite":
+            return self.composite_scan(es, docs_hash, unique_fields, index, args)
+        if args.prefilter:
+            return self.prefiltered_scan(es, docs_hash, unique_fields, index, args)
+        return self.scan(es, docs_hash, unique_fields, index, args)
+
+    def es_query(self, args, unique_fields=None):
+        query = {}
         if args.timestamp:
             filter = {"format": "strict_date_optional_time"}
             if args.since:
@@ -284,20 +1173,249 @@ class Esdedupe:
             if args.until:
                 # Less than
                 filter["lt"] = to_es_date(args.until)
-            query = {
-                "query": {"bool": {"filter": [{"range": {args.timestamp: filter}}]}}
+            query["query"] = {
+                "bool": {"filter": [{"range": {args.timestamp: filter}}]}
             }
-            return query
+        if unique_fields is not None:
+            query.update(self.fetch_fields(args, unique_fields))
+        return query
+
+    # fetch only fields that form the unique key (and timestamp),
+    # documents can be orders of magnitude larger than the key itself
+    def fetch_fields(self, args, unique_fields):
+        fields = unique_fields.es_fields()
+        if args.timestamp and args.timestamp not in fields:
+            fields.append(args.timestamp)
+        if unique_fields.fetch == "docvalue":
+            query = {"_source": False, "docvalue_fields": fields}
+        elif unique_fields.fetch == "stored":
+            query = {"_source": False, "stored_fields": fields}
         else:
-            {}
+            query = {"_source": fields}
+        if args.lookback:
+            # --lookback compares timestamps as epoch millis, regardless of
+            # the field format
+            docvalues = query.get("docvalue_fields", [])
+            query["docvalue_fields"] = [f for f in docvalues if f != args.timestamp]
+            query["docvalue_fields"].append(
+                {"field": args.timestamp, "format": "epoch_millis"}
+            )
+        return query
 
+    # Fetch documents of duplicate groups using batched mget requests, up to
+    # --check-concurrency requests are sent at once. Output keeps the order
+    # of groups.
     def print_duplicates(self, docs_hash, index, es, args):
-        for hashval, ids in docs_hash.items():
-            if len(ids) > 1:
-                # Get the documents that have mapped to the current hasval
-                matching_docs = es.mget(index=index, body={"ids": ids})
-                for doc in matching_docs["docs"]:
-                    print("doc=%s" % doc)
+        client = es.options(request_timeout=args.request_timeout)
+        params = self.print_params(args)
+        concurrency = max(args.check_concurrency, 1)
+
+        def fetch(batch):
+            ids = [doc_id for key, doc_id, keep in batch]
+            return batch, client.mget(index=index, ids=ids, **params)["docs"]
+
+        with self.print_output(args) as out, ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="mget"
+        ) as pool:
+            pending = collections.deque()
+            for batch in self.doc_batches(docs_hash.duplicate_groups(), args.batch):
+                pending.append(pool.submit(fetch, batch))
+                if len(pending) >= concurrency:
+                    self.print_docs(out, *pending.popleft().result())
+            while pending:
+                self.print_docs(out, *pending.popleft().result())
+
+    # Split (key, ids) groups into batches of (hex key, ID, kept) tuples,
+    # a large group may span multiple batches
+    def doc_batches(self, groups, size):
+        docs = (
+            (key.hex(), doc_id, i == 0)
+            for key, ids in groups
+            for i, doc_id in enumerate(ids)
+        )
+        while True:
+            batch = list(itertools.islice(docs, size))
+            if not batch:
+                return
+            yield batch
+
+    def print_params(self, args):
+        if args.print_fields:
+            return {"source_includes": args.print_fields.split(",")}
+        return {}
+
+    @contextmanager
+    def print_output(self, args):
+        if not args.print_docs or args.print_docs == "-":
+            yield sys.stdout
+            sys.stdout.flush()
+            return
+        self.log.info("Writing duplicate documents into {}".format(args.print_docs))
+        with open(args.print_docs, "w", encoding="utf8") as out:
+            yield out
+
+    # one JSON line per document, `keep` marks the document that is kept
+    def print_docs(self, out, batch, docs):
+        for (key, doc_id, keep), doc in zip(batch, docs):
+            line = {"key": key, "keep": keep}
+            line.update(doc)
+            out.write(ujson.dumps(line))
+            out.write("\n")
+
+    # Verify that duplicates are gone and kept documents remain, duplicates
+    # that are still present are deleted once more
+    def check_removed(self, docs_hash, index, es, args):
+        cache = self.caches.get(index, ())
+        # groups carried from previous window have no kept document
+        groups = (
+            (hashval, ids)
+            for hashval, ids in docs_hash.duplicate_groups()
+            if hashval not in cache
+        )
+        return self.check_groups(groups, index, es, args)
+
+    # Verify deletion of (key, ids) groups, duplicates that are still present
+    # are deleted again
+    def check_groups(self, groups, index, es, args):
+        present = self.verify(groups, index, es, args)["present"]
+        if not present:
+            return 0
+        self.log.warning(
+            "{:0,} duplicates are still present, deleting them again".format(
+                len(present)
+            )
+        )
+        actions = [self.delete_action(index, doc_id, args) for doc_id in present]
+        return self.bulk_delete(actions, es, args, len(actions))
+
+    # Delete duplicates listed in mapping saved by --log_dupl without scanning
+    # the index, the first document of every group is kept
+    def replay(self, es, args):
+        index = args.index
+        self.log.info(
+            "Deleting duplicates from mapping {} in index {}".format(
+                args.from_mapping, index
+            )
+        )
+        # the mapping is read twice, counting also validates the whole file
+        # before anything is deleted
+        groups = 0
+        dupl = 0
+        for key, ids in read_groups(args.from_mapping):
+            groups += 1
+            dupl += len(ids) - 1
+        self.metrics.inc("esdedupe_duplicates_total", dupl)
+        self.log.info("Found {:0,} duplicates in {:0,} groups".format(dupl, groups))
+        if dupl == 0 or args.noop:
+            return 0
+        actions = (
+            self.delete_action(index, doc_id, args)
+            for key, ids in read_groups(args.from_mapping)
+            for doc_id in ids[1:]
+        )
+        with self.phase("delete"):
+            removed = self.bulk_delete(actions, es, args, dupl)
+        if not args.no_check:
+            with self.phase("verify"):
+                removed += self.check_groups(
+                    read_groups(args.from_mapping), index, es, args
+                )
+        self.log.info(
+            "Altogether {} documents were removed from {} ({})".format(
+                removed, index, self.removed_note(args)
+            )
+        )
+        return removed
+
+    # Verify mapping saved by --log_dupl, returns False when any duplicate
+    # is still present or any kept document is missing
+    def check_log(self, es, args):
+        self.log.info(
+            "Verifying documents mapping {} against index {}".format(
+                args.check, args.index
+            )
+        )
+        stats = self.verify(read_groups(args.check), args.index, es, args)
+        return not (stats["present"] or stats["missing"] or stats["errors"])
+
+    # Check existence of all documents from (key, ids) groups using batched
+    # mget requests, up to --check-concurrency requests are sent at once.
+    # IDs of kept documents that were found are written to --log_done.
+    def verify(self, groups, index, es, args):
+        client = es.options(request_timeout=args.request_timeout)
+        stats = {"groups": 0, "docs": 0, "present": [], "missing": [], "errors": 0}
+        concurrency = max(args.check_concurrency, 1)
+        progress = None
+        if not args.no_progress:
+            progress = tqdm.tqdm(unit="docs", desc="verify")
+        done = None
+        if args.log_done:
+            done = open(args.log_done, "w", encoding="utf8")
+
+        def fetch(batch):
+            ids = [doc_id for doc_id, keep in batch]
+            return batch, client.mget(index=index, ids=ids, source=False)["docs"]
+
+        def batches():
+            batch = []
+            for key, ids in groups:
+                stats["groups"] += 1
+                # the first document of every group is kept
+                batch.append((ids[0], True))
+                batch.extend([(doc_id, False) for doc_id in ids[1:]])
+                if len(batch) >= args.batch:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        def collect(futures):
+            for future in futures:
+                batch, docs = future.result()
+                for (doc_id, keep), doc in zip(batch, docs):
+                    if "error" in doc:
+                        stats["errors"] += 1
+                        self.log.error(
+                            "Unable to verify {}: {}".format(doc_id, doc["error"])
+                        )
+                    elif keep and not doc["found"]:
+                        stats["missing"].append(doc_id)
+                    elif not keep and doc["found"]:
+                        stats["present"].append(doc_id)
+                    elif keep and done is not None:
+                        done.write(doc_id + "\n")
+                stats["docs"] += len(batch)
+                if progress is not None:
+                    progress.update(len(batch))
+
+        try:
+            with ThreadPoolExecutor(
+                max_workers=concurrency, thread_name_prefix="check"
+            ) as pool:
+                pending = set()
+                for batch in batches():
+                    if len(pending) >= concurrency:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(finished)
+                    pending.add(pool.submit(fetch, batch))
+                collect(as_completed(pending))
+        finally:
+            if done is not None:
+                done.close()
+
+        self.log.info(
+            "Verified {:0,} documents in {:0,} groups, duplicates still present: {:0,}, kept documents missing: {:0,}".format(
+                stats["docs"],
+                stats["groups"],
+                len(stats["present"]),
+                len(stats["missing"]),
+            )
+        )
+        if stats["missing"]:
+            self.log.error(
+                "Kept documents missing: {}".format(", ".join(stats["missing"][:10]))
+            )
+        return stats
 
     # For catching Elasticsearch exceptions
     def wrapper(self, gen):
@@ -311,54 +1429,93 @@ class Esdedupe:
                 # which is good, we don't overload ES cluster
                 self.log.error(e)
 
-    def sequential_delete(self, docs_hash, index, es, args, duplicates):
-        if not args.no_progress:
-            progress = tqdm.tqdm(unit="docs", total=duplicates)
-        successes = 0
+    # Send delete actions, `total` is used only for progress reporting. A
+    # `progress` bar shared by multiple calls might be passed in, otherwise a
+    # new one is created.
+    def bulk_delete(self, actions, es, args, total=None, progress=None):
+        if args.delete_engine == "adaptive":
+            return self.bulk_adaptive(actions, es, args, total, progress)
+        if args.delete_engine == "dbq":
+            return self.delete_by_query(actions, es, args, total, progress)
+        if args.threads > 1:
+            return self.bulk_parallel(actions, es, args, total, progress)
+        # safer option, should avoid overloading elastic
+        return self.bulk_sequential(actions, es, args, total, progress)
+
+    def progress_bar(self, args, total=None, progress=None):
+        if progress is None and not args.no_progress:
+            progress = tqdm.tqdm(unit="docs", total=total)
+        return progress
 
-        for success, info in self.wrapper(
+    def bulk_sequential(self, actions, es, args, total=None, progress=None):
+        return self.bulk_results(
             streaming_bulk(
                 es,
-                self.delete_iterator(docs_hash, index, args),
+                actions,
                 max_retries=args.max_retries,
                 initial_backoff=args.initial_backoff,
                 request_timeout=args.request_timeout,
                 chunk_size=args.flush,
                 raise_on_exception=args.fail_fast,
-            )
-        ):
-            if success:
-                successes += info["delete"]["_shards"]["successful"]
-            else:
-                print("Doc failed", info)
-            if not args.no_progress:
-                progress.update(1)
-
-        self.log.info(
-            "Deleted {:0,} documents (including shard replicas)".format(successes)
+            ),
+            args,
+            total,
+            progress,
         )
-        return successes
 
-    def parallel_delete(self, docs_hash, index, es, args, duplicates):
-        if not args.no_progress:
-            progress = tqdm.tqdm(unit="docs", total=duplicates)
-        successes = 0
-
-        for success, info in self.wrapper(
+    def bulk_parallel(self, actions, es, args, total=None, progress=None):
+        return self.bulk_results(
             parallel_bulk(
                 es,
-                self.delete_iterator(docs_hash, index, args),
+                actions,
                 thread_count=args.threads,
                 request_timeout=args.request_timeout,
                 chunk_size=args.flush,
                 raise_on_exception=args.fail_fast,
+            ),
+            args,
+            total,
+            progress,
+        )
+
+    def bulk_adaptive(self, actions, es, args, total=None, progress=None):
+        progress = self.progress_bar(args, total, progress)
+        bulk = AdaptiveBulk(es, args)
+        successes = bulk.run(actions, progress)
+        self.metrics.inc("esdedupe_docs_deleted_total", successes)
+        self.metrics.inc("esdedupe_bulk_retries_total", bulk.retries)
+        self.log.info(
+            "Deleted {:0,} documents (including shard replicas), failed: {:0,}, rejected: {:0,}, final chunk size: {}, concurrency: {}".format(
+                successes, bulk.failed, bulk.rejected, bulk.chunk, bulk.concurrency
             )
-        ):
+        )
+        return successes
+
+    # documents are deleted by the cluster, only IDs are sent
+    def delete_by_query(self, actions, es, args, total=None, progress=None):
+        progress = self.progress_bar(args, total, progress)
+        dbq = DeleteByQuery(es, args)
+        deleted = dbq.run(actions, progress)
+        self.metrics.inc("esdedupe_dbq_docs_deleted_total", deleted)
+        self.log.info(
+            "Deleted {:0,} documents (replicas not counted) using {:0,} delete_by_query tasks, failed: {:0,}, version conflicts: {:0,}".format(
+                deleted, dbq.tasks, dbq.failed, dbq.conflicts
+            )
+        )
+        return deleted
+
+    def bulk_results(self, results, args, total, progress=None):
+        progress = self.progress_bar(args, total, progress)
+        successes = 0
+
+        for success, info in self.wrapper(results):
             if success:
-                successes += info["delete"]["_shards"]["successful"]
+                deleted = info["delete"]["_shards"]["successful"]
+                successes += deleted
+                self.metrics.inc("esdedupe_docs_deleted_total", deleted)
             else:
                 print("Doc failed", info)
-            if not args.no_progress:
+            if progress is not None:
                 progress.update(1)
 
         self.log.info(
@@ -367,26 +1524,58 @@ class Esdedupe:
         return successes
 
     def delete_iterator(self, docs_hash, index, args):
-        for hashval, ids in docs_hash.items():
-            if len(ids) > 1:
-                i = 0
-                for doc_id in ids:
-                    if i > 0:  # skip first document
-                        doc = {"_op_type": "delete", "_index": index, "_id": doc_id}
-                        if args.doc_type:
-                            doc["_type"] = args.doc_type
-                        yield doc
-                    i += 1
+        cache = self.caches.get(index, ())
+        for hashval, ids in docs_hash.duplicate_groups():
+            if hashval in cache:
+                continue
+            # skip first document
+            for doc_id in ids[1:]:
+                yield self.delete_action(index, doc_id, args)
+        # the document kept for these keys is in previous window
+        for hashval in cache:
+            for doc_id in docs_hash.get(hashval, []):
+                yield self.delete_action(index, doc_id, args)
+
+    def delete_action(self, index, doc_id, args):
+        doc = {"_op_type": "delete", "_index": index, "_id": doc_id}
+        if args.doc_type:
+            doc["_type"] = args.doc_type
+        return doc
 
     def count_duplicates(self, docs_hash):
-        duplicates = 0
-        for hashval, ids in docs_hash.items():
-            size = len(ids)
-            if size > 1:
-                duplicates += size - 1
-        return duplicates
-
-    def save_documents_mapping(self, docs_hash, args):
-        self.log.info("Storing documents mapping into: {}".format(args.log_dupl))
-        with open(args.log_dupl, "w", encoding="utf8") as ujson_file:
-            ujson.dump(docs_hash, ujson_file)
+        # KeyStore keeps track of documents sharing a key while inserting
+        return docs_hash.duplicates
+
+    # --log_dupl path for given index and window. With --all every index and
+    # every window has its own file (e.g. `docs.nginx-2021.01.29.json` or
+    # `docs.20210101T000000000Z.json` for `docs.json`), otherwise they would
+    # overwrite each other
+    def mapping_path(self, args, index, window=None):
+        parts = []
+        if args.all:
+            parts.append(index)
+        if window is not None:
+            parts.append(re.sub(r"[^0-9A-Za-z]", "", window.split("/")[0]))
+        if not parts:
+            return args.log_dupl
+        path = args.log_dupl
+        compressed = ""
+        if path.endswith(".gz"):
+            path, compressed = path[:-3], ".gz"
+        base, ext = os.path.splitext(path)
+        return "{}.{}{}{}".format(base, ".".join(parts), ext, compressed)
+
+    # only groups with duplicates are stored, written one by one. Groups
+    # carried from previous window (--lookback) are left out, their first
+    # document is deleted as well, which replay assumes is kept.
+    def save_documents_mapping(self, docs_hash, index, path, args):
+        self.log.info(
+            "Storing duplicates mapping into: {} ({})".format(path, args.log_format)
+        )
+        cache = self.caches.get(index, ())
+        with MappingWriter(path, args.log_format) as writer:
+            for hashval, ids in docs_hash.duplicate_groups():
+                if hashval in cache:
+                    continue
+                writer.write(hashval, ids)
+        self.log.info("Stored {:0,} groups".format(writer.groups))
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+import hashlib
+import re
+
+# `a.b[0].c` -> ["a", "b", 0, "c"]
+PATH_TOKEN = re.compile(r"([^.\[\]]+)|\[(\d+)\]")
+
+
+def parse_path(path):
+    parts = []
+    for name, idx in PATH_TOKEN.findall(path):
+        parts.append(int(idx) if idx else name)
+    if not parts:
+        raise ValueError("Invalid field path: '{}'".format(path))
+    return parts
+
+
+# Walk nested dicts, lists are either indexed explicitly (`tags[0]`) or
+# the rest of the path is applied to every element (`items.name`)
+def _walk(value, parts, i):
+    while i < len(parts):
+        part = parts[i]
+        if isinstance(value, list) and not isinstance(part, int):
+            return [_walk(item, parts, i) for item in value]
+        if not isinstance(value, list if isinstance(part, int) else dict):
+            # e.g. `name.keyword` is a sub-field, it doesn't exist in `_source`
+            raise ValueError(
+                "Can't read '{}' of field '{}', its value is {}: {!r}".format(
+                    part, _path(parts[:i]), type(value).__name__, value
+                )
+            )
+        value = value[part]
+        i += 1
+    return value
+
+
+def _path(parts):
+    path = ""
+    for part in parts:
+        if isinstance(part, int):
+            path += "[{}]".format(part)
+        else:
+            path += "." + part if path else part
+    return path
+
+
+# Compile field path into a function reading the value from `_source` dict
+def compile_field(path):
+    parts = parse_path(path)
+    if len(parts) == 1:
+        name = parts[0]
+
+        def getter(source):
+            return source[name]
+
+        return getter
+
+    def nested_getter(source):
+        # documents might also contain flattened keys, e.g. {"a.b": 1}
+        if path in source:
+            return source[path]
+        return _walk(source, parts, 0)
+
+    return nested_getter
+
+
+# Compile field path into a function reading the value from `fields` section
+# of a hit (docvalue_fields/stored_fields), where every value is an array
+def compile_doc_field(path):
+    parts = parse_path(path)
+    name = ".".join([p for p in parts if not isinstance(p, int)])
+    idx = parts[-1] if isinstance(parts[-1], int) else None
+
+    def getter(fields):
+        values = fields[name]
+        if idx is not None:
+            return values[idx]
+        if len(values) == 1:
+            return values[0]
+        return values
+
+    return getter
+
+
+# field name as understood by Elasticsearch, e.g. `tags[0]` -> `tags`
+def es_field(path):
+    return ".".join([p for p in parse_path(path) if not isinstance(p, int)])
+
+
+# string representation of a field value used for building the key, arrays
+# are serialized element by element to avoid depending on Python's repr
+def value_str(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return "[" + ",".join([value_str(v) for v in value]) + "]"
+    return str(value)
+
+
+# --key-hash functions, `none` keeps raw values (fixed width, exact)
+HASHES = ("md5", "blake2b", "xxhash", "none")
+# joins values of multiple fields, ASCII unit separator doesn't appear in
+# regular text, thus ("ab", "c") and ("a", "bc") give different keys
+SEPARATOR = "\x1f"
+
+
+def xxhash_available():
+    try:
+        import xxhash  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# Number of bytes of keys produced by `name` hash, `size` is requested size
+# (None for hash's default)
+def hash_size(name, size=None):
+    if name == "md5":
+        if size not in (None, 16):
+            raise ValueError("md5 produces 16 bytes long keys")
+        return 16
+    if name == "blake2b":
+        size = 16 if size is None else size
+        if not 1 <= size <= 64:
+            raise ValueError("blake2b produces 1-64 bytes long keys")
+        return size
+    if name == "xxhash":
+        size = 16 if size is None else size
+        if size not in (8, 16):
+            raise ValueError("xxhash produces 8 or 16 bytes long keys")
+        return size
+    if name == "none":
+        if size is None or not 2 <= size <= 256:
+            raise ValueError("raw keys require --key-size between 2 and 256 bytes")
+        return size
+    raise ValueError("Unsupported key hash: '{}'".format(name))
+
+
+# Function turning encoded key into `size` bytes long digest
+def digest_function(name, size):
+    if name == "md5":
+
+        def md5(data):
+            return hashlib.md5(data).digest()
+
+        return md5
+    if name == "blake2b":
+
+        def blake2b(data):
+            return hashlib.blake2b(data, digest_size=size).digest()
+
+        return blake2b
+    if name == "xxhash":
+        import xxhash
+
+        if size == 8:
+            return xxhash.xxh3_64_digest
+        return xxhash.xxh3_128_digest
+
+    # length prefixed raw value padded with zeros
+    def raw(data):
+        if len(data) >= size:
+            raise ValueError(
+                "Key {!r} doesn't fit into {} bytes, increase --key-size or use --key-hash".format(
+                    data, size
+                )
+            )
+        return bytes([len(data)]) + data + bytes(size - 1 - len(data))
+
+    return raw
+
+
+# Turns raw search hits into fixed width keys. Field accessors are compiled
+# just once, so that no per-hit parsing of field paths is needed.
+#
+# `fetch` determines where are the values read from: `source` (`_source`
+# filtered to just the unique fields), `docvalue` (docvalue_fields) or
+# `stored` (stored_fields). Values are joined using `separator` and hashed
+# by `hash` (see HASHES) into `key_size` bytes.
+class KeyBuilder:
+    FETCH = ("source", "docvalue", "stored")
+
+    def __init__(
+        self, fields, fetch="source", hash="md5", key_size=None, separator=SEPARATOR
+    ):
+        if fetch not in self.FETCH:
+            raise ValueError("Unsupported fetch mode: '{}'".format(fetch))
+        self.fields = fields
+        self.fetch = fetch
+        self.hash = hash
+        self.key_size = hash_size(hash, key_size)
+        self.separator = separator
+        self._digest = digest_function(hash, self.key_size)
+        if fetch == "source":
+            self._section = "_source"
+            self._getters = [compile_field(f) for f in fields]
+        else:
+            self._section = "fields"
+            self._getters = [compile_doc_field(f) for f in fields]
+
+    # fields that have to be requested from Elasticsearch
+    def es_fields(self):
+        names = []
+        for f in self.fields:
+            name = es_field(f)
+            if name not in names:
+                names.append(name)
+        return names
+
+    def __call__(self, hit):
+        source = hit[self._section]
+        if len(self._getters) == 1:
+            key = value_str(self._getters[0](source))
+        else:
+            key = self.separator.join(
+                [value_str(getter(source)) for getter in self._getters]
+            )
+        return self._digest(key.encode("utf-8"))
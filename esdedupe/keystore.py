@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+from array import array
+
+
+# Compact duplicate index mapping fixed-width keys to document IDs.
+#
+# Keys live in one contiguous bytearray (open addressing, linear probing),
+# document `_id`s are interned into a byte arena and each group is a chain
+# of document numbers, so a singleton group costs no Python object at all.
+# Chains are built newest-first, groups are returned oldest-first, i.e. the
+# first document ever seen for a key is always the first ID of its group.
+#
+# With `ids=False` only keys are kept, which is enough to tell whether a key
+# has been seen before (see `add`), but groups can't be listed.
+#
+# Document numbers are 32-bit, a single store holds up to 2^31 - 1 documents.
+class KeyStore:
+    EMPTY = -1
+    LOAD_FACTOR = 0.6
+    MAX_DOCS = 2**31 - 1
+
+    def __init__(self, key_size=16, capacity=1024, ids=True):
+        self.key_size = key_size
+        self.ids = ids
+        self._count = 0
+        cap = 16
+        while cap * self.LOAD_FACTOR < capacity:
+            cap <<= 1
+        self._alloc(cap)
+        # number of unique keys
+        self._used = 0
+        # number of documents that share a key with an earlier document
+        self.duplicates = 0
+        # per document: offset of its `_id` end in the arena, next doc in group
+        self._arena = bytearray()
+        self._offsets = array("q", [0])
+        self._next = array("i")
+
+    def _alloc(self, cap):
+        self._cap = cap
+        self._mask = cap - 1
+        self._limit = int(cap * self.LOAD_FACTOR)
+        self._keys = bytearray(cap * self.key_size)
+        self._heads = array("i", [self.EMPTY]) * cap
+
+    def __len__(self):
+        return self._used
+
+    # total number of documents stored
+    @property
+    def docs(self):
+        return self._count
+
+    def _slot(self, key):
+        ks = self.key_size
+        keys = self._keys
+        heads = self._heads
+        mask = self._mask
+        # keys aren't necessarily uniform digests (--key-hash none)
+        pos = hash(key) & mask
+        while True:
+            if heads[pos] == self.EMPTY:
+                return pos
+            start = pos * ks
+            if keys[start : start + ks] == key:
+                return pos
+            pos = (pos + 1) & mask
+
+    def _grow(self):
+        ks = self.key_size
+        old_keys = self._keys
+        old_heads = self._heads
+        self._alloc(self._cap << 1)
+        for pos, head in enumerate(old_heads):
+            if head != self.EMPTY:
+                key = bytes(old_keys[pos * ks : (pos + 1) * ks])
+                slot = self._slot(key)
+                self._keys[slot * ks : (slot + 1) * ks] = key
+                self._heads[slot] = head
+
+    # Store document `_id` under given key digest, returns True when the key
+    # hasn't been seen before (i.e. the document is going to be kept)
+    def add(self, key, _id):
+        if len(key) != self.key_size:
+            raise ValueError(
+                "Expected {} bytes long key, got {}".format(self.key_size, len(key))
+            )
+        if self._used >= self._limit:
+            self._grow()
+        doc = self._count
+        if not self.ids:
+            self._count += 1
+            return self._add_key(key)
+        if doc >= self.MAX_DOCS:
+            raise OverflowError(
+                "Can't store more than {:0,} documents".format(self.MAX_DOCS)
+            )
+        self._count += 1
+        self._arena += _id.encode("utf-8")
+        self._offsets.append(len(self._arena))
+        pos = self._slot(key)
+        head = self._heads[pos]
+        self._heads[pos] = doc
+        if head == self.EMPTY:
+            ks = self.key_size
+            self._keys[pos * ks : (pos + 1) * ks] = key
+            self._used += 1
+            self._next.append(self.EMPTY)
+            return True
+        self._next.append(head)
+        self.duplicates += 1
+        return False
+
+    def _add_key(self, key):
+        pos = self._slot(key)
+        if self._heads[pos] == self.EMPTY:
+            ks = self.key_size
+            self._keys[pos * ks : (pos + 1) * ks] = key
+            self._heads[pos] = 0
+            self._used += 1
+            return True
+        self.duplicates += 1
+        return False
+
+    def __contains__(self, key):
+        return self._heads[self._slot(key)] != self.EMPTY
+
+    def _doc_id(self, doc):
+        return self._arena[self._offsets[doc] : self._offsets[doc + 1]].decode("utf-8")
+
+    def _require_ids(self):
+        if not self.ids:
+            raise RuntimeError("Document IDs are not stored, only keys")
+
+    def _group(self, head):
+        ids = []
+        doc = head
+        while doc != self.EMPTY:
+            ids.append(self._doc_id(doc))
+            doc = self._next[doc]
+        ids.reverse()
+        return ids
+
+    # IDs stored for given key, first seen document first
+    def get(self, key, default=None):
+        self._require_ids()
+        head = self._heads[self._slot(key)]
+        if head == self.EMPTY:
+            return default
+        return self._group(head)
+
+    # Iterate over all (key, ids) groups
+    def groups(self):
+        self._require_ids()
+        ks = self.key_size
+        for pos, head in enumerate(self._heads):
+            if head != self.EMPTY:
+                yield bytes(self._keys[pos * ks : (pos + 1) * ks]), self._group(head)
+
+    # Iterate only over groups that contain more than one document
+    def duplicate_groups(self):
+        self._require_ids()
+        ks = self.key_size
+        nxt = self._next
+        for pos, head in enumerate(self._heads):
+            if head != self.EMPTY and nxt[head] != self.EMPTY:
+                yield bytes(self._keys[pos * ks : (pos + 1) * ks]), self._group(head)
+
+    # approximate number of bytes held by the store
+    def nbytes(self):
+        return (
+            len(self._keys)
+            + self._heads.itemsize * len(self._heads)
+            + len(self._arena)
+            + self._offsets.itemsize * len(self._offsets)
+            + self._next.itemsize * len(self._next)
+        )
+
+    # everything is held in memory, nothing to release
+    def close(self):
+        pass
+
+
+# Keys of documents from the end of previous time windows, with the latest
+# timestamp (epoch millis) they were seen at. Keys are remembered while a
+# window is being scanned, but become visible only once the next window
+# starts, so that the window doesn't treat its own documents as seen before.
+# Keys older than `lookback` millis before the window start are evicted.
+class KeyCache:
+    def __init__(self, lookback):
+        self.lookback = lookback
+        self.tail = 0
+        self._keys = {}
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    # window [since, until) is about to be scanned
+    def start(self, since, until):
+        for key, ts in self._pending.items():
+            if ts > self._keys.get(key, -1):
+                self._keys[key] = ts
+        self._pending = {}
+        cutoff = since - self.lookback
+        self._keys = {key: ts for key, ts in self._keys.items() if ts >= cutoff}
+        # only documents this close to the window end matter for the next one
+        self.tail = until - self.lookback
+
+    def remember(self, key, ts):
+        if ts > self._pending.get(key, -1):
+            self._pending[key] = ts
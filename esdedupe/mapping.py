@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+import gzip
+import io
+import json
+import ujson
+
+DECODER = json.JSONDecoder()
+
+FORMATS = ("json", "ndjson", "binary")
+# header of binary mapping
+MAGIC = b"ESDDUPL\x01"
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+# Incremental parser of a JSON object `{"key": [ids], ...}`, members are
+# decoded one by one from a small buffer
+class _ObjectReader:
+    CHUNK = 1024 * 1024
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+
+    def _fill(self):
+        chunk = self.f.read(self.CHUNK)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    # next non-whitespace character, empty string at the end of file
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars):
+        c = self.peek()
+        if c == "" or c not in chars:
+            raise ValueError(
+                "Invalid mapping file, expected '{}', got '{}'".format(chars, c)
+            )
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, self.pos = DECODER.raw_decode(self.buf, self.pos)
+                return value
+            except ValueError:
+                # value continues in the next chunk
+                if not self._fill():
+                    raise
+
+    def members(self):
+        self.expect("{")
+        if self.peek() == "}":
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key, self.value()
+            if self.expect(",}") == "}":
+                return
+
+
+# Binary mapping: MAGIC followed by groups, each group is
+#   varint key length, key, varint number of IDs, (varint ID length, ID)...
+class _BinaryReader:
+    CHUNK = 1024 * 1024
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = b""
+        self.pos = 0
+
+    # make sure `n` bytes are buffered, False at the end of file
+    def _need(self, n):
+        while len(self.buf) - self.pos < n:
+            chunk = self.f.read(self.CHUNK)
+            if not chunk:
+                return False
+            self.buf = self.buf[self.pos :] + chunk
+            self.pos = 0
+        return True
+
+    # None at the end of file
+    def varint(self):
+        result = 0
+        shift = 0
+        while True:
+            if not self._need(1):
+                if shift == 0:
+                    return None
+                raise ValueError("Invalid mapping file, truncated varint")
+            b = self.buf[self.pos]
+            self.pos += 1
+            result |= (b & 0x7F) << shift
+            if b < 0x80:
+                return result
+            shift += 7
+
+    def read(self, n):
+        if not self._need(n):
+            raise ValueError("Invalid mapping file, truncated group")
+        data = self.buf[self.pos : self.pos + n]
+        self.pos += n
+        return data
+
+    def groups(self):
+        while True:
+            size = self.varint()
+            if size is None:
+                return
+            key = self.read(size)
+            count = self.varint()
+            ids = [self.read(self.varint()).decode("utf-8") for _ in range(count)]
+            yield key.hex(), ids
+
+
+def _varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def _open(path):
+    with open(path, "rb") as f:
+        compressed = f.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    return gzip.open(path, "rb") if compressed else open(path, "rb")
+
+
+# format of a mapping file, gzip compression is detected as well
+def detect_format(path):
+    with _open(path) as f:
+        head = f.read(len(MAGIC))
+        if head == MAGIC:
+            return "binary"
+        while head:
+            text = head.lstrip()
+            if text:
+                return "ndjson" if text[:1] == b"[" else "json"
+            head = f.read(len(MAGIC))
+    # empty file
+    return "ndjson"
+
+
+# Writes duplicate groups one by one, `.gz` files are gzip compressed
+#   json    {"hex key": [ids], ...}
+#   ndjson  ["hex key", [ids]] on every line
+#   binary  see _BinaryReader
+class MappingWriter:
+    def __init__(self, path, fmt="json"):
+        if fmt not in FORMATS:
+            raise ValueError("Unknown mapping format {}".format(fmt))
+        self.fmt = fmt
+        self.groups = 0
+        if path.endswith(".gz"):
+            self.f = gzip.open(path, "wb", compresslevel=6)
+        else:
+            self.f = open(path, "wb")
+        if fmt == "json":
+            self.f.write(b"{")
+        elif fmt == "binary":
+            self.f.write(MAGIC)
+
+    def write(self, key, ids):
+        if self.fmt == "json":
+            sep = "," if self.groups else ""
+            line = "{}{}:{}".format(sep, ujson.dumps(key.hex()), ujson.dumps(ids))
+            self.f.write(line.encode("utf-8"))
+        elif self.fmt == "ndjson":
+            self.f.write(ujson.dumps([key.hex(), ids]).encode("utf-8") + b"\n")
+        else:
+            out = _varint(len(key))
+            out += key
+            out += _varint(len(ids))
+            for doc_id in ids:
+                raw = doc_id.encode("utf-8")
+                out += _varint(len(raw))
+                out += raw
+            self.f.write(out)
+        self.groups += 1
+
+    def close(self):
+        if self.fmt == "json":
+            self.f.write(b"}")
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Iterate over (hex key, ids) groups of mapping saved using --log_dupl, the
+# first ID of every group is the document that is kept. Format and
+# compression are detected automatically.
+def read_groups(path):
+    fmt = detect_format(path)
+    with _open(path) as raw:
+        if fmt == "binary":
+            reader = _BinaryReader(raw)
+            reader.read(len(MAGIC))
+            for key, ids in reader.groups():
+                yield key, ids
+            return
+        with io.TextIOWrapper(raw, encoding="utf8") as f:
+            if fmt == "ndjson":
+                for line in f:
+                    if line.strip():
+                        key, ids = ujson.loads(line)
+                        yield key, ids
+            else:
+                for key, ids in _ObjectReader(f).members():
+                    yield key, ids
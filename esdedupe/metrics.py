@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+import os
+import psutil
+import tempfile
+import threading
+import time
+import ujson
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+
+# name: (type, help)
+METRICS = {
+    "esdedupe_phase_seconds_total": ("counter", "Time spent in phase"),
+    "esdedupe_docs_scanned_total": ("counter", "Documents read from Elasticsearch"),
+    "esdedupe_scroll_page_seconds": ("histogram", "Latency of search/scroll requests"),
+    "esdedupe_mapping_keys": ("gauge", "Unique keys (groups) in documents mapping"),
+    "esdedupe_mapping_docs": ("gauge", "Documents in documents mapping"),
+    "esdedupe_mapping_bytes": ("gauge", "Approximate size of documents mapping"),
+    "esdedupe_duplicates_total": ("counter", "Duplicate documents found"),
+    "esdedupe_bulk_request_seconds": ("histogram", "Latency of bulk requests"),
+    "esdedupe_bulk_rejected_total": ("counter", "Bulk items rejected (HTTP 429)"),
+    "esdedupe_bulk_retries_total": ("counter", "Bulk items sent again"),
+    "esdedupe_docs_deleted_total": (
+        "counter",
+        "Deleted documents (including shard replicas)",
+    ),
+    "esdedupe_dbq_docs_deleted_total": (
+        "counter",
+        "Documents deleted by delete_by_query tasks (replicas not counted)",
+    ),
+    "esdedupe_resident_memory_bytes": ("gauge", "Resident memory of the process"),
+}
+
+# seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    # cumulative counts as expected by Prometheus
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+def _labels(labels, extra=None):
+    items = sorted(labels.items())
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(['{}="{}"'.format(k, v) for k, v in items]) + "}"
+
+
+# Thread-safe registry of counters, gauges and latency histograms. Samples
+# are keyed by metric name and labels, updates are cheap enough to be done
+# once per search page or bulk request.
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._histograms = {}
+        self.started = time.time()
+        self.phase = None
+
+    def _key(self, name, labels):
+        if name not in METRICS:
+            raise KeyError("Unknown metric {}".format(name))
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._values.get(self._key(name, labels), 0)
+
+    # time spent in the block is added to esdedupe_phase_seconds_total
+    @contextmanager
+    def timed(self, phase):
+        previous = self.phase
+        self.phase = phase
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.inc("esdedupe_phase_seconds_total", time.time() - start, phase=phase)
+            self.phase = previous
+
+    # sizes of documents mapping, counting unique keys of a disk based
+    # mapping requires merging all runs, thus `keys` is optional
+    def mapping(self, docs_hash, keys=None):
+        self.set("esdedupe_mapping_docs", docs_hash.docs)
+        self.set("esdedupe_mapping_bytes", docs_hash.nbytes())
+        if keys is not None:
+            self.set("esdedupe_mapping_keys", keys)
+
+    def _rss(self):
+        rss = psutil.Process(os.getpid()).memory_info().rss
+        self.set("esdedupe_resident_memory_bytes", rss)
+
+    # Prometheus text exposition format
+    def prometheus(self):
+        self._rss()
+        with self._lock:
+            values = dict(self._values)
+            histograms = {
+                k: (list(h.cumulative()), h.sum, h.count)
+                for k, h in self._histograms.items()
+            }
+        lines = []
+        for name, (kind, text) in METRICS.items():
+            lines.append("# HELP {} {}".format(name, text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append("{}{} {}".format(name, _labels(dict(labels)), value))
+            for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                labels = dict(labels)
+                for bound, cumulative in buckets:
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            name, _labels(labels, ("le", bound)), cumulative
+                        )
+                    )
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        name, _labels(labels, ("le", "+Inf")), count
+                    )
+                )
+                lines.append("{}_sum{} {}".format(name, _labels(labels), total))
+                lines.append("{}_count{} {}".format(name, _labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    # JSON friendly snapshot including per-phase rates
+    def snapshot(self):
+        self._rss()
+        with self._lock:
+            values = dict(self._values)
+            histograms = {
+                k: (list(h.cumulative()), h.sum, h.count)
+                for k, h in self._histograms.items()
+            }
+        result = {
+            "timestamp": time.time(),
+            "elapsed": time.time() - self.started,
+            "phase": self.phase,
+            "metrics": {},
+        }
+        for (name, labels), value in sorted(values.items()):
+            result["metrics"].setdefault(name, []).append(
+                {"labels": dict(labels), "value": value}
+            )
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            result["metrics"].setdefault(name, []).append(
+                {
+                    "labels": dict(labels),
+                    "count": count,
+                    "sum": total,
+                    "mean": total / count if count else 0,
+                    "buckets": {str(bound): n for bound, n in buckets},
+                }
+            )
+        scanned = values.get(("esdedupe_docs_scanned_total", ()), 0)
+        scan_time = values.get(
+            ("esdedupe_phase_seconds_total", (("phase", "scan"),)), 0
+        )
+        deleted = values.get(("esdedupe_docs_deleted_total", ()), 0) + values.get(
+            ("esdedupe_dbq_docs_deleted_total", ()), 0
+        )
+        delete_time = values.get(
+            ("esdedupe_phase_seconds_total", (("phase", "delete"),)), 0
+        )
+        result["scan_docs_per_sec"] = scanned / scan_time if scan_time else 0
+        result["deletes_per_sec"] = deleted / delete_time if delete_time else 0
+        return result
+
+
+# Elasticsearch client proxy measuring latency and rejections of bulk
+# requests, bulk helpers use `options()` and `bulk()` only
+class TimedClient:
+    def __init__(self, client, metrics):
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def options(self, **kwargs):
+        return TimedClient(self._client.options(**kwargs), self._metrics)
+
+    def bulk(self, *args, **kwargs):
+        start = time.time()
+        try:
+            resp = self._client.bulk(*args, **kwargs)
+        finally:
+            self._metrics.observe("esdedupe_bulk_request_seconds", time.time() - start)
+        if resp.get("errors"):
+            rejected = 0
+            for item in resp["items"]:
+                if next(iter(item.values())).get("status") == 429:
+                    rejected += 1
+            if rejected:
+                self._metrics.inc("esdedupe_bulk_rejected_total", rejected)
+        return resp
+
+
+class _Handler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.metrics.prometheus()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = ujson.dumps(self.metrics.snapshot())
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        raw = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+
+# Expose metrics over HTTP (/metrics and /metrics.json) and/or write JSON
+# snapshot into a file every `interval` seconds
+class MetricsExporter:
+    def __init__(self, metrics, port=None, path=None, interval=10):
+        self.log = getLogger("esdedupe")
+        self.metrics = metrics
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self._server = None
+        self._stop = threading.Event()
+        self._writer = None
+
+    def start(self):
+        if self.port:
+            handler = type("Handler", (_Handler,), {"metrics": self.metrics})
+            self._server = ThreadingHTTPServer(("", self.port), handler)
+            self._server.daemon_threads = True
+            threading.Thread(
+                target=self._server.serve_forever, name="metrics", daemon=True
+            ).start()
+            self.log.info(
+                "Serving metrics on http://0.0.0.0:{}/metrics".format(self.port)
+            )
+        if self.path:
+            self._writer = threading.Thread(
+                target=self._write_periodically, name="metrics-file", daemon=True
+            )
+            self._writer.start()
+
+    def _write_periodically(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(prefix=".metrics-", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                ujson.dump(self.metrics.snapshot(), f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    # final snapshot is always written
+    def stop(self):
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+            self.write()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
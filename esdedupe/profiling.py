@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from logging import getLogger
+
+from .utils import bytes_fmt
+
+
+# Per-phase CPU and allocation profile, enabled by --profile DIR. Every phase
+# (scan, detect, delete, ...) has its own cProfile profiler, repeated phases
+# (indices, windows) are accumulated. Allocations are traced by tracemalloc
+# only while a phase is running, so the report shows memory allocated within
+# the phase and still held at its end (e.g. the documents mapping) and the
+# peak of traced memory.
+#
+# cProfile sees only the thread that entered the phase, bulk workers started
+# by -j N are not included.
+class Profiler:
+    # number of entries in text reports
+    TOP = 30
+
+    def __init__(self, directory, frames=5):
+        self.log = getLogger("esdedupe")
+        self.directory = directory
+        self.frames = frames
+        self._lock = threading.Lock()
+        self._active = None
+        self.phases = {}
+
+    def _phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = {
+                "profile": cProfile.Profile(),
+                "calls": 0,
+                "seconds": 0.0,
+                "peak": 0,
+                "allocations": {},
+            }
+        return self.phases[name]
+
+    # only one phase can be profiled at a time, phases overlapping an active
+    # one (e.g. concurrent windows) aren't profiled
+    @contextmanager
+    def phase(self, name):
+        with self._lock:
+            if self._active is not None:
+                self.log.debug(
+                    "Phase {} overlaps {}, not profiled".format(name, self._active)
+                )
+                profiled = False
+            else:
+                self._active = name
+                profiled = True
+        if not profiled:
+            yield
+            return
+        stats = self._phase(name)
+        tracemalloc.start(self.frames)
+        start = time.time()
+        stats["profile"].enable()
+        try:
+            yield
+        finally:
+            stats["profile"].disable()
+            stats["seconds"] += time.time() - start
+            stats["calls"] += 1
+            snapshot = tracemalloc.take_snapshot()
+            stats["peak"] = max(stats["peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            self._allocations(stats["allocations"], snapshot)
+            with self._lock:
+                self._active = None
+
+    # memory held at the end of phase, summed by allocation site
+    def _allocations(self, allocations, snapshot):
+        snapshot = snapshot.filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            )
+        )
+        for stat in snapshot.statistics("traceback"):
+            key = tuple(stat.traceback.format())
+            size, count = allocations.get(key, (0, 0))
+            allocations[key] = (size + stat.size, count + stat.count)
+
+    # writes <phase>.prof (pstats, e.g. for snakeviz) and <phase>.txt
+    def write(self):
+        if not self.phases:
+            self.log.info("No phase has been profiled")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for name, stats in self.phases.items():
+            prof = os.path.join(self.directory, "{}.prof".format(name))
+            stats["profile"].dump_stats(prof)
+            txt = os.path.join(self.directory, "{}.txt".format(name))
+            with open(txt, "w") as f:
+                f.write(self.report(name, stats))
+            self.log.info(
+                "Profile of phase {} ({:.1f}s) written to {}".format(
+                    name, stats["seconds"], txt
+                )
+            )
+
+    def report(self, name, stats):
+        out = io.StringIO()
+        out.write(
+            "phase: {}, runs: {}, time: {:.3f}s, traced memory peak: {}\n\n".format(
+                name, stats["calls"], stats["seconds"], bytes_fmt(stats["peak"])
+            )
+        )
+        out.write("CPU (top {} by cumulative time)\n".format(self.TOP))
+        ps = pstats.Stats(stats["profile"], stream=out)
+        ps.sort_stats("cumulative").print_stats(self.TOP)
+        out.write("Memory held at the end of phase (top {})\n\n".format(self.TOP))
+        top = sorted(stats["allocations"].items(), key=lambda i: i[1][0], reverse=True)
+        for traceback, (size, count) in top[: self.TOP]:
+            out.write("{} in {:0,} blocks\n".format(bytes_fmt(size), count))
+            for line in traceback:
+                out.write("    {}\n".format(line))
+            out.write("\n")
+        return out.getvalue()
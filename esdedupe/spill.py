@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+import heapq
+import os
+import shutil
+import struct
+import tempfile
+
+from logging import getLogger
+
+from .utils import bytes_fmt
+
+# sequence number of the document and length of its `_id`
+RECORD = struct.Struct(">QH")
+
+
+# Bounded-memory duplicate index (external sort). Records `(key, _id)` are
+# buffered until the memory budget is reached, then sorted and written into
+# a run file. Groups are produced by k-way merge of all runs, so memory usage
+# doesn't depend on number of documents. At most MAX_FAN_IN runs are merged at
+# once, more runs are first merged into intermediate ones (multiple levels if
+# needed). Offers the same interface as KeyStore except that `add` can't tell
+# whether the key has been seen before.
+class SpillStore:
+    # rough size of buffered record in memory (tuple, bytes, int and str)
+    RECORD_OVERHEAD = 200
+    MAX_FAN_IN = 64
+    # file buffer of every merged run, taken from the budget
+    READ_BUFFER = 1024 * 1024
+    MIN_READ_BUFFER = 64 * 1024
+
+    def __init__(self, budget, key_size=16, directory=None):
+        self.log = getLogger("esdedupe")
+        self.key_size = key_size
+        self.budget = budget
+        self._dir = tempfile.mkdtemp(prefix="esdedupe-", dir=directory)
+        self._buffer = []
+        self._buffered = 0
+        self._runs = []
+        self._files = 0
+        self._seq = 0
+        self._io_buffer = min(
+            self.READ_BUFFER,
+            max(self.MIN_READ_BUFFER, budget // (self.MAX_FAN_IN + 1)),
+        )
+        self._unique = None
+        self._duplicates = None
+
+    def add(self, key, _id):
+        if len(key) != self.key_size:
+            raise ValueError(
+                "Expected {} bytes long key, got {}".format(self.key_size, len(key))
+            )
+        self._buffer.append((key, self._seq, _id))
+        self._seq += 1
+        self._buffered += self.RECORD_OVERHEAD + len(key) + len(_id)
+        self._unique = None
+        if self._buffered >= self.budget:
+            self._spill()
+
+    def _spill(self):
+        self._buffer.sort()
+        path = self._write(self._buffer)
+        self._runs.append(path)
+        self.log.debug(
+            "Spilled {:0,} records into {} ({})".format(
+                len(self._buffer), path, bytes_fmt(os.path.getsize(path))
+            )
+        )
+        self._buffer = []
+        self._buffered = 0
+
+    # writes sorted records into a new run file
+    def _write(self, records):
+        path = os.path.join(self._dir, "run-{:05d}".format(self._files))
+        self._files += 1
+        with open(path, "wb", buffering=self._io_buffer) as f:
+            for key, seq, _id in records:
+                raw = _id.encode("utf-8")
+                f.write(key)
+                f.write(RECORD.pack(seq, len(raw)))
+                f.write(raw)
+        return path
+
+    def _read(self, path):
+        ks = self.key_size
+        head = ks + RECORD.size
+        with open(path, "rb", buffering=self._io_buffer) as f:
+            while True:
+                rec = f.read(head)
+                if not rec:
+                    return
+                seq, size = RECORD.unpack_from(rec, ks)
+                yield rec[:ks], seq, f.read(size).decode("utf-8")
+
+    # merge runs in groups of MAX_FAN_IN until the final merge (together with
+    # the in-memory buffer) fits in the fan-in, intermediate runs are kept for
+    # subsequent iterations
+    def _compact(self):
+        while len(self._runs) >= self.MAX_FAN_IN:
+            merged = []
+            for i in range(0, len(self._runs), self.MAX_FAN_IN):
+                runs = self._runs[i : i + self.MAX_FAN_IN]
+                if len(runs) == 1:
+                    merged.append(runs[0])
+                    continue
+                path = self._write(heapq.merge(*[self._read(run) for run in runs]))
+                for run in runs:
+                    os.unlink(run)
+                merged.append(path)
+            self.log.debug(
+                "Merged {:0,} runs into {:0,}".format(len(self._runs), len(merged))
+            )
+            self._runs = merged
+
+    # all records sorted by key and order of appearance
+    def _records(self):
+        self._buffer.sort()
+        if not self._runs:
+            return iter(self._buffer)
+        self._compact()
+        return heapq.merge(self._buffer, *[self._read(run) for run in self._runs])
+
+    # Iterate over all (key, ids) groups, ordered by key
+    def groups(self):
+        key = None
+        ids = []
+        for k, seq, _id in self._records():
+            if k != key:
+                if ids:
+                    yield key, ids
+                key = k
+                ids = []
+            ids.append(_id)
+        if ids:
+            yield key, ids
+
+    # Iterate only over groups that contain more than one document
+    def duplicate_groups(self):
+        for key, ids in self.groups():
+            if len(ids) > 1:
+                yield key, ids
+
+    def _count(self):
+        if self._unique is None:
+            unique = 0
+            duplicates = 0
+            for key, ids in self.groups():
+                unique += 1
+                duplicates += len(ids) - 1
+            self._unique = unique
+            self._duplicates = duplicates
+
+    def __len__(self):
+        self._count()
+        return self._unique
+
+    @property
+    def duplicates(self):
+        self._count()
+        return self._duplicates
+
+    # total number of documents stored
+    @property
+    def docs(self):
+        return self._seq
+
+    # approximate number of bytes held in memory
+    def nbytes(self):
+        return self._buffered
+
+    # number of bytes written to disk
+    def spilled(self):
+        return sum([os.path.getsize(run) for run in self._runs])
+
+    def close(self):
+        self._buffer = []
+        self._runs = []
+        shutil.rmtree(self._dir, ignore_errors=True)
@@ -2,11 +2,13 @@
 
 # -*- coding: utf-8 -*-
 
+import datetime
 import os.path
 import psutil
 
 
 SEC_PER_UNIT = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+BYTES_PER_UNIT = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
 
 
 def bytes_fmt(num, suffix="B"):
@@ -28,6 +30,24 @@ def time_to_sec(s):
     return int(s[:-1]) * SEC_PER_UNIT[s[-1]]
 
 
+# convert human readable size to bytes, e.g. 512M, 2G
+def size_to_bytes(s):
+    s = s.upper().rstrip("B")
+    if s[-1] in BYTES_PER_UNIT:
+        return int(float(s[:-1]) * BYTES_PER_UNIT[s[-1]])
+    return int(s)
+
+
 # format datetime into Elastic's strict_date_optional_time
 def to_es_date(dt):
     return dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+# parse date formatted by to_es_date
+def from_es_date(s):
+    return datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.000Z")
+
+
+# naive UTC datetime to epoch millis
+def to_epoch_millis(dt):
+    return int(dt.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
@@ -23,12 +23,13 @@ setup(
         "console_scripts": "esdedupe=esdedupe.cmd:main",
     },
     install_requires=["elasticsearch>5.0" "psutil", "tqdm", "ujson", "requests"],
+    extras_require={"async": ["elasticsearch[async]"], "xxhash": ["xxhash"]},
     license="Apache License 2.0",
     keywords="elasticsearch",
     long_description=long_description,
     long_description_content_type="text/markdown",
     name="esdedupe",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*", "tests", "tests.*"]),
     url="https://github.com/deric/es-dedupe",
     version=esdedupe.__VERSION__,
 )
@@ -0,0 +1,145 @@
+import pytest
+
+from esdedupe import adaptive
+from esdedupe.adaptive import REJECTED, AdaptiveBulk
+from esdedupe.cli import ArgumentParser
+
+
+# Bulk responses are scripted by a list of item statuses (or an exception) per
+# request, requests beyond the script succeed on 2 shard copies
+class FakeClient:
+    def __init__(self, script=(), pool=None):
+        self.script = list(script)
+        self.pool = pool
+        self.requests = []
+        self.cat = self
+
+    def options(self, **kwargs):
+        return self
+
+    def bulk(self, operations):
+        ids = [op["delete"]["_id"] for op in operations]
+        self.requests.append(ids)
+        statuses = self.script.pop(0) if self.script else 200
+        if isinstance(statuses, Exception):
+            raise statuses
+        if isinstance(statuses, int):
+            statuses = [statuses] * len(ids)
+        items = []
+        for doc_id, status in zip(ids, statuses):
+            op = {"_id": doc_id, "status": status}
+            if status == 429:
+                op["error"] = {"type": REJECTED}
+            elif status < 300:
+                op["_shards"] = {"total": 2, "successful": 2, "failed": 0}
+            items.append({"delete": op})
+        return {"errors": False, "items": items}
+
+    def thread_pool(self, **kwargs):
+        if self.pool is None:
+            raise RuntimeError("not available")
+        return self.pool.pop(0)
+
+
+class Rejected(Exception):
+    status_code = 429
+
+
+def actions(n):
+    return [{"_op_type": "delete", "_index": "test", "_id": str(i)} for i in range(n)]
+
+
+def parse(*argv):
+    return ArgumentParser().parse_args(
+        ["--delete-engine", "adaptive", "--initial_backoff", "1"] + list(argv)
+    )
+
+
+@pytest.fixture()
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(adaptive.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_grow(sleeps):
+    es = FakeClient()
+    bulk = AdaptiveBulk(es, parse("--flush", "10", "--max-flush", "20", "-j", "3"))
+    assert bulk.run(actions(300)) == 600
+    # chunk grows first, concurrency once chunk reached its maximum
+    assert [len(ids) for ids in es.requests[:4]] == [10, 13, 17, 20]
+    assert bulk.chunk == 20
+    assert bulk.concurrency == 3
+    assert bulk.failed == 0
+    assert sleeps == []
+
+
+def test_shrink_slow_requests():
+    bulk = AdaptiveBulk(FakeClient(), parse("--flush", "100", "-j", "2"))
+    bulk.concurrency = 2
+    bulk._feedback(latency=2.0, size=100)
+    assert bulk.chunk == 80
+    bulk.chunk = AdaptiveBulk.MIN_CHUNK
+    # chunk can't shrink anymore, concurrency is reduced instead
+    bulk._feedback(latency=2.0, size=AdaptiveBulk.MIN_CHUNK)
+    assert bulk.chunk == AdaptiveBulk.MIN_CHUNK
+    assert bulk.concurrency == 1
+
+
+def test_rejected_items_retried(sleeps):
+    # every other item of the first request is rejected
+    es = FakeClient([[200, 429] * 50, Rejected("too many requests")])
+    bulk = AdaptiveBulk(es, parse("--flush", "100"))
+    assert bulk.run(actions(100)) == 200
+    assert bulk.rejected == 100
+    assert bulk.retries == 100
+    assert bulk.failed == 0
+    # rejected items go first in the next request
+    assert es.requests[1] == [str(i) for i in range(1, 100, 2)]
+    # whole request rejected, retried in halved chunks
+    assert es.requests[2] == es.requests[1][:25]
+    # remaining retried items
+    assert [len(ids) for ids in es.requests] == [100, 50, 25, 25]
+    assert sleeps == [1, 2]
+
+
+def test_retries_exhausted(sleeps):
+    es = FakeClient([429] * 10)
+    bulk = AdaptiveBulk(es, parse("--flush", "10", "--max_retries", "2"))
+    assert bulk.run(actions(10)) == 0
+    assert len(es.requests) == 3
+    assert bulk.rejected == 30
+    assert bulk.retries == 20
+    assert bulk.failed == 10
+    assert sleeps == [1, 2, 4]
+
+
+def test_thread_pool_rejections(sleeps):
+    pool = [
+        [{"node_name": "n1", "queue": "0", "queue_size": "200", "rejected": "5"}],
+        [{"node_name": "n1", "queue": "150", "queue_size": "200", "rejected": "8"}],
+    ]
+    bulk = AdaptiveBulk(FakeClient(pool=pool), parse("--flush", "100"))
+    bulk._poll_thread_pool()
+    assert sleeps == []
+    bulk._last_poll = 0
+    bulk._poll_thread_pool()
+    assert bulk.chunk == 50
+    assert bulk._busy
+    assert sleeps == [1]
+
+
+def test_throttle(monkeypatch, sleeps):
+    now = [100.0]
+    monkeypatch.setattr(adaptive.time, "time", lambda: now[0])
+    bulk = AdaptiveBulk(FakeClient(), parse("--max-rate", "100"))
+    bulk._start = 100.0
+    bulk._throttle(50)
+    assert sleeps == []
+    # 50 docs sent within the first half second
+    bulk._throttle(50)
+    assert sleeps == [0.5]
+    now[0] = 102.0
+    bulk._throttle(50)
+    assert sleeps == [0.5]
+    assert bulk._sent == 150
@@ -0,0 +1,111 @@
+import asyncio
+import json
+
+import pytest
+
+from types import SimpleNamespace
+
+from esdedupe.aio import AsyncEsdedupe
+from esdedupe.cli import ArgumentParser
+
+
+class BulkFailed(Exception):
+    pass
+
+
+# Async bulk API used by async_streaming_bulk, every request takes a while so
+# that concurrent streams overlap. `fail` is a set of request numbers (from 1)
+# raising an exception.
+class FakeAsyncClient:
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.requests = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self.deleted = []
+        self.transport = SimpleNamespace(
+            serializers=SimpleNamespace(get_serializer=lambda mimetype: Serializer())
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def options(self, **kwargs):
+        return self
+
+    async def bulk(self, operations, **kwargs):
+        self.requests += 1
+        request = self.requests
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.inflight -= 1
+        if request in self.fail:
+            raise BulkFailed("bulk request {} failed".format(request))
+        items = []
+        for line in operations:
+            doc_id = json.loads(line)["delete"]["_id"]
+            self.deleted.append(doc_id)
+            items.append(
+                {
+                    "delete": {
+                        "_id": doc_id,
+                        "status": 200,
+                        "_shards": {"total": 2, "successful": 2, "failed": 0},
+                    }
+                }
+            )
+        return SimpleNamespace(body={"errors": False, "items": items})
+
+
+class Serializer:
+    def dumps(self, data):
+        return json.dumps(data).encode("utf-8")
+
+
+def actions(n):
+    return ({"_op_type": "delete", "_index": "idx", "_id": str(i)} for i in range(n))
+
+
+def delete(client, n, *argv):
+    dedupe = AsyncEsdedupe()
+    dedupe.async_client = lambda args: client
+    args = ArgumentParser().parse_args(
+        ["--async", "--flush", "10", "--no-progress"] + list(argv)
+    )
+    return dedupe.bulk_delete(actions(n), None, args, n)
+
+
+def test_streams():
+    client = FakeAsyncClient()
+    assert delete(client, 200, "--max-inflight", "3") == 400
+    assert sorted(client.deleted, key=int) == [str(i) for i in range(200)]
+    # never more than --max-inflight concurrent bulk requests
+    assert client.max_inflight == 3
+
+
+def test_single_stream():
+    client = FakeAsyncClient()
+    assert delete(client, 50, "--max-inflight", "1") == 100
+    assert client.max_inflight == 1
+
+
+def test_failed_request_skipped():
+    client = FakeAsyncClient(fail={2})
+    # the failed chunk is lost, the stream carries on with the next actions
+    removed = delete(client, 100, "--max-inflight", "2")
+    assert removed == 2 * len(client.deleted)
+    assert 100 - 10 - 1 <= len(client.deleted) <= 100 - 10
+    assert "99" in client.deleted
+
+
+def test_fail_fast():
+    client = FakeAsyncClient(fail={2})
+    with pytest.raises(BulkFailed):
+        delete(client, 1000, "--max-inflight", "2", "--fail-fast")
+    assert client.requests < 100
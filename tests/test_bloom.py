@@ -0,0 +1,32 @@
+import hashlib
+
+import pytest
+
+from esdedupe.bloom import BloomFilter
+
+
+def key(i):
+    return hashlib.md5(str(i).encode()).digest()
+
+
+def test_no_false_negatives():
+    bloom = BloomFilter(10000, 0.01)
+    for i in range(10000):
+        assert not bloom.add(key(i)) or key(i) in bloom
+    for i in range(10000):
+        assert key(i) in bloom
+        assert bloom.add(key(i))
+
+
+def test_error_rate():
+    bloom = BloomFilter(10000, 0.01)
+    assert bloom.hashes == 7
+    for i in range(10000):
+        bloom.add(key(i))
+    false_positives = sum([1 for i in range(10000, 30000) if key(i) in bloom])
+    assert false_positives < 20000 * 0.02
+
+
+def test_invalid_error_rate():
+    with pytest.raises(ValueError):
+        BloomFilter(100, 0)
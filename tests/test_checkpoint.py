@@ -0,0 +1,39 @@
+import pytest
+
+from esdedupe.checkpoint import Checkpoint
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    cp = Checkpoint(path, "Uuid")
+    first = Checkpoint.window_key(
+        "2021-01-01T00:00:00.000Z", "2021-01-01T01:00:00.000Z"
+    )
+    second = Checkpoint.window_key(
+        "2021-01-01T01:00:00.000Z", "2021-01-01T02:00:00.000Z"
+    )
+    cp.complete_window("idx", first, 10)
+    cp.advance("idx", second, {"search_after": ["foo", 42], "removed": 5})
+
+    cp = Checkpoint(path, "Uuid")
+    assert cp.window_done("idx", first)
+    assert not cp.window_done("idx", second)
+    assert cp.position("idx", first) is None
+    assert cp.position("idx", second) == {"search_after": ["foo", 42], "removed": 5}
+    assert cp.removed("idx") == 10
+    assert not cp.index_done("idx")
+
+    cp.complete_window("idx", second, 7)
+    cp.complete_index("idx")
+    cp = Checkpoint(path, "Uuid")
+    assert cp.index_done("idx")
+    assert cp.removed("idx") == 17
+    assert cp.position("idx", second) is None
+    assert not cp.index_done("other")
+
+
+def test_different_fields(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    Checkpoint(path, "Uuid").complete_index("idx", 3)
+    with pytest.raises(ValueError):
+        Checkpoint(path, "request_id")
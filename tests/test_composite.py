@@ -0,0 +1,156 @@
+from esdedupe.cli import ArgumentParser
+from esdedupe.esdedupe import Esdedupe
+from esdedupe.fields import KeyBuilder
+from esdedupe.keystore import KeyStore
+
+
+def matches(doc, query):
+    if "terms" in query:
+        ((field, values),) = query["terms"].items()
+        return doc[field] in values
+    if "term" in query:
+        ((field, value),) = query["term"].items()
+        return doc[field] == value
+    clauses = query["bool"]
+    if not all(matches(doc, q) for q in clauses.get("filter", [])):
+        return False
+    should = clauses.get("should")
+    return not should or any(matches(doc, q) for q in should)
+
+
+# Composite aggregation over documents given as dicts of doc values, searches
+# with a query return all matching documents in a single scroll page
+class CompositeClient:
+    def __init__(self, docs):
+        self.docs = docs
+        self.afters = []
+        self.queries = []
+        self.cleared = []
+
+    def options(self, **kwargs):
+        return self
+
+    def search(self, index, size, aggs=None, query=None, scroll=None, **kwargs):
+        if aggs is not None:
+            return self.composite(aggs["keys"]["composite"])
+        assert kwargs["_source"] is False
+        self.queries.append(query["bool"]["filter"])
+        hits = [
+            {
+                "_index": index,
+                "_id": "doc-{}".format(i),
+                "fields": {f: [doc[f]] for f in kwargs["docvalue_fields"]},
+            }
+            for i, doc in enumerate(self.docs)
+            if matches(doc, query)
+        ]
+        return {
+            "_scroll_id": "scroll-{}".format(len(self.queries)),
+            "_shards": {"total": 1, "successful": 1},
+            "hits": {"hits": hits},
+        }
+
+    def scroll(self, scroll_id, scroll):
+        return {"_scroll_id": scroll_id, "hits": {"hits": []}}
+
+    def clear_scroll(self, scroll_id):
+        self.cleared.append(scroll_id)
+
+    def composite(self, composite):
+        names = [list(source)[0] for source in composite["sources"]]
+        after = composite.get("after")
+        self.afters.append(after)
+        counts = {}
+        for doc in self.docs:
+            key = tuple(doc[name] for name in names)
+            counts[key] = counts.get(key, 0) + 1
+        keys = sorted(counts)
+        if after is not None:
+            keys = [k for k in keys if k > tuple(after[name] for name in names)]
+        buckets = [
+            {"key": dict(zip(names, key)), "doc_count": counts[key]}
+            for key in keys[: composite["size"]]
+        ]
+        agg = {"buckets": buckets}
+        if buckets:
+            agg["after_key"] = buckets[-1]["key"]
+        return {"aggregations": {"keys": agg}}
+
+
+def docs(*names):
+    return [{"name": name} for name in names]
+
+
+def parse(*argv):
+    return ArgumentParser().parse_args(
+        ["--engine", "composite", "-b", "2"] + list(argv)
+    )
+
+
+def test_duplicate_buckets_paging():
+    es = CompositeClient(docs("a", "a", "b", "c", "c", "c", "d", "e", "e"))
+    keys = list(Esdedupe().duplicate_buckets(es, ["name"], "idx", parse()))
+    assert keys == [{"name": "a"}, {"name": "c"}, {"name": "e"}]
+    # pages [a, b], [c, d], [e] and an empty one
+    assert es.afters == [None, {"name": "b"}, {"name": "d"}, {"name": "e"}]
+
+
+def test_fetch_duplicate_keys():
+    es = CompositeClient(docs("a", "a", "b", "c", "c", "c", "d", "e", "e"))
+    pk = KeyBuilder(["name"], "docvalue")
+    store = KeyStore()
+    assert Esdedupe().composite_scan(es, store, pk, "idx", parse()) == 4
+    # keys of up to --batch groups are fetched at once
+    assert es.queries == [
+        [{"terms": {"name": ["a", "c"]}}],
+        [{"terms": {"name": ["e"]}}],
+    ]
+    assert es.cleared == ["scroll-1", "scroll-2"]
+    assert sorted(ids for key, ids in store.duplicate_groups()) == [
+        ["doc-0", "doc-1"],
+        ["doc-3", "doc-4", "doc-5"],
+        ["doc-7", "doc-8"],
+    ]
+
+
+def test_fetch_multi_field_keys():
+    es = CompositeClient(
+        [
+            {"name": "a", "code": 1},
+            {"name": "a", "code": 1},
+            {"name": "a", "code": 2},
+            {"name": "b", "code": 1},
+            {"name": "b", "code": 1},
+        ]
+    )
+    pk = KeyBuilder(["name", "code"], "docvalue")
+    store = KeyStore()
+    assert Esdedupe().composite_scan(es, store, pk, "idx", parse("-b", "10")) == 2
+    # every key is a conjunction of its field values
+    assert es.queries == [
+        [
+            {
+                "bool": {
+                    "should": [
+                        {
+                            "bool": {
+                                "filter": [
+                                    {"term": {"name": "a"}},
+                                    {"term": {"code": 1}},
+                                ]
+                            }
+                        },
+                        {
+                            "bool": {
+                                "filter": [
+                                    {"term": {"name": "b"}},
+                                    {"term": {"code": 1}},
+                                ]
+                            }
+                        },
+                    ],
+                    "minimum_should_match": 1,
+                }
+            }
+        ]
+    ]
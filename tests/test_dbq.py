@@ -0,0 +1,115 @@
+import pytest
+
+from esdedupe import dbq
+from esdedupe.cli import ArgumentParser
+from esdedupe.dbq import DeleteByQuery
+
+
+# Tasks complete after `polls` status requests, `results` maps task number
+# (from 1) to a scripted task response
+class FakeClient:
+    def __init__(self, polls=2, results=None):
+        self.polls = polls
+        self.results = results or {}
+        self.submitted = []
+        self.requests = {}
+        self.removed = []
+        self.tasks = self
+
+    def options(self, **kwargs):
+        return self
+
+    def delete_by_query(self, index, query, **kwargs):
+        assert kwargs["wait_for_completion"] is False
+        ids = query["ids"]["values"]
+        self.submitted.append((index, ids))
+        task = "node:{}".format(len(self.submitted))
+        self.requests[task] = 0
+        return {"task": task}
+
+    def get(self, task_id):
+        self.requests[task_id] += 1
+        if self.requests[task_id] < self.polls:
+            return {"completed": False, "task": {}}
+        n = int(task_id.split(":")[1])
+        resp = self.results.get(n)
+        if resp is None:
+            resp = {"response": {"deleted": len(self.submitted[n - 1][1])}}
+        return dict(resp, completed=True)
+
+    def delete(self, index, id):
+        assert index == ".tasks"
+        self.removed.append(id)
+
+
+def actions(index, n, start=0):
+    return [
+        {"_op_type": "delete", "_index": index, "_id": str(i)}
+        for i in range(start, start + n)
+    ]
+
+
+def parse(*argv):
+    return ArgumentParser().parse_args(
+        ["--delete-engine", "dbq", "--dbq-batch", "3"] + list(argv)
+    )
+
+
+@pytest.fixture()
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(dbq.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_batches_per_index(sleeps):
+    es = FakeClient()
+    deleter = DeleteByQuery(es, parse("-j", "2"))
+    assert deleter.run(actions("a", 4) + actions("b", 2, 4) + actions("a", 1, 6)) == 7
+    # batches never mix indices
+    assert es.submitted == [
+        ("a", ["0", "1", "2"]),
+        ("a", ["3"]),
+        ("b", ["4", "5"]),
+        ("a", ["6"]),
+    ]
+    assert deleter.tasks == 4
+    # every task result is removed once read
+    assert sorted(es.removed) == ["node:1", "node:2", "node:3", "node:4"]
+    assert all(polls == 2 for polls in es.requests.values())
+
+
+def test_poll_backoff(sleeps):
+    es = FakeClient(polls=5)
+    DeleteByQuery(es, parse()).run(actions("a", 2))
+    # long running tasks are polled less often
+    assert sleeps == [0.1, 0.2, 0.4, 0.8, 1.6]
+
+
+def test_failures_and_conflicts(sleeps):
+    es = FakeClient(
+        results={
+            1: {
+                "response": {
+                    "deleted": 1,
+                    "version_conflicts": 1,
+                    "failures": [{"id": "2", "cause": {"type": "boom"}}],
+                }
+            },
+            2: {"error": {"type": "task_cancelled_exception"}},
+        }
+    )
+    deleter = DeleteByQuery(es, parse())
+    assert deleter.run(actions("a", 5)) == 1
+    assert deleter.conflicts == 1
+    # one failure of the first task, the whole second batch
+    assert deleter.failed == 3
+    assert sorted(es.removed) == ["node:1", "node:2"]
+
+
+def test_fail_fast(sleeps):
+    es = FakeClient(results={1: {"error": {"type": "task_cancelled_exception"}}})
+    deleter = DeleteByQuery(es, parse("--fail-fast"))
+    with pytest.raises(RuntimeError):
+        deleter.run(actions("a", 6))
+    assert es.removed == ["node:1"]
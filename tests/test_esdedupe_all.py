@@ -0,0 +1,95 @@
+import pytest
+from elasticsearch import Elasticsearch
+import random
+import string
+import time
+
+import esdedupe
+from esdedupe.cli import ArgumentParser
+
+PREFIX = "test-all"
+INDICES = ["test-all-1", "test-all-2", "test-all-skip"]
+# matches the prefix, but can't be scanned
+CLOSED = "test-all-closed"
+
+
+def random_string(length):
+    # Random string with the combination of lower and upper case
+    letters = string.ascii_letters + string.digits
+    return "".join(random.SystemRandom().choice(letters) for i in range(length))
+
+
+@pytest.fixture()
+def dedupe():
+    print("setup")
+    es = Elasticsearch()
+
+    for index in INDICES:
+        # ignore 400 cause by IndexAlreadyExistsException when creating an index
+        es.indices.create(index=index, ignore=400, wait_for_active_shards=1)
+        print("Created index {}".format(index))
+
+        # fill with documents
+        for i in range(10):
+            es.create(index=index, id=random_string(8), body={"name": "foo"})
+        for i in range(10):
+            es.create(index=index, id=random_string(8), body={"name": "bar"})
+
+    es.indices.create(index=CLOSED, ignore=400, wait_for_active_shards=1)
+    es.create(index=CLOSED, id=random_string(8), body={"name": "foo"}, refresh=True)
+    es.indices.close(index=CLOSED)
+
+    yield "dedupe"
+
+    # cleanup
+    for index in INDICES + [CLOSED]:
+        es.indices.delete(index=index, ignore=400)
+
+
+class TestDedupe:
+    def test_docs(self, dedupe):
+        es = Elasticsearch()
+        # make sure elastic indexes inserted documents
+        for index in INDICES:
+            i = 0
+            res = es.count(index=index)
+            while res["count"] < 20:
+                time.sleep(1)
+                i += 1
+                res = es.count(index=index)
+                if i > 3:
+                    assert False
+
+        dedupe = esdedupe.Esdedupe()
+        parser = ArgumentParser()
+        dedupe.run(
+            parser.parse_args(
+                [
+                    "--all",
+                    "--prefix",
+                    PREFIX,
+                    "--indexexclude",
+                    "skip$",
+                    "--index-concurrency",
+                    "2",
+                    "--field",
+                    "name",
+                    "--log-stream-stdout",
+                    "--no-progress",
+                    "--fail-fast",
+                ]
+            )
+        )
+
+        for index in INDICES[:2]:
+            i = 0
+            res = es.count(index=index)
+            while res["count"] == 20:
+                time.sleep(1)
+                i += 1
+                res = es.count(index=index)
+                if i > 3:
+                    assert False
+            assert res["count"] == 2
+
+        assert es.count(index=INDICES[2])["count"] == 20
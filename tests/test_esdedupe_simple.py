@@ -73,3 +73,40 @@ class TestDedupe:
                 assert False
 
         assert es.count(index=INDEX)["count"] == 2
+
+    def test_replay_mapping(self, dedupe, tmp_path):
+        es = Elasticsearch()
+        res = es.count(index=INDEX)
+
+        i = 0
+        while res["count"] < 20:
+            time.sleep(1)
+            i += 1
+            res = es.count(index=INDEX)
+            if i > 3:
+                assert False
+
+        mapping = str(tmp_path / "mapping.ndjson.gz")
+        args = ["-i", INDEX, "--log-stream-stdout", "--no-progress"]
+        parser = ArgumentParser()
+        esdedupe.Esdedupe().run(
+            parser.parse_args(
+                args
+                + ["--field", "name", "--noop", "--log_dupl", mapping]
+                + ["--log-format", "ndjson"]
+            )
+        )
+        assert es.count(index=INDEX)["count"] == 20
+
+        # no scanning, only the mapping is needed
+        esdedupe.Esdedupe().run(parser.parse_args(args + ["--from-mapping", mapping]))
+
+        i = 0
+        while res["count"] == 20:
+            time.sleep(1)
+            i += 1
+            res = es.count(index=INDEX)
+            if i > 3:
+                assert False
+
+        assert es.count(index=INDEX)["count"] == 2
@@ -0,0 +1,105 @@
+import hashlib
+
+import pytest
+
+from esdedupe.fields import (
+    KeyBuilder,
+    compile_field,
+    parse_path,
+    value_str,
+    xxhash_available,
+)
+
+
+def test_parse_path():
+    assert parse_path("Uuid") == ["Uuid"]
+    assert parse_path("a.b[1].c") == ["a", "b", 1, "c"]
+    with pytest.raises(ValueError):
+        parse_path("")
+
+
+def test_nested_access():
+    source = {
+        "a": {"b": [{"c": 1}, {"c": 2}]},
+        "tags": ["x", "y"],
+        "flat.key": "v",
+    }
+    assert compile_field("a.b[1].c")(source) == 2
+    assert compile_field("a.b.c")(source) == [1, 2]
+    assert compile_field("tags[0]")(source) == "x"
+    assert compile_field("flat.key")(source) == "v"
+    with pytest.raises(KeyError):
+        compile_field("missing")(source)
+    # sub-fields (e.g. `name.keyword`) aren't part of `_source`
+    with pytest.raises(ValueError, match=r"'keyword' of field 'tags\[0\]'"):
+        compile_field("tags[0].keyword")(source)
+
+
+def test_value_str():
+    assert value_str("a") == "a"
+    assert value_str(5) == "5"
+    assert value_str(["a", 1, ["b"]]) == "[a,1,[b]]"
+
+
+def test_key_builder():
+    hit = {"_id": "1", "_source": {"time": 10, "device": {"id": "abc"}}}
+    single = KeyBuilder(["time"])
+    assert single(hit) == hashlib.md5(b"10").digest()
+    multi = KeyBuilder(["time", "device.id"])
+    assert multi(hit) == hashlib.md5(b"10\x1fabc").digest()
+    assert KeyBuilder(["time", "device.id"], separator="")(hit) == (
+        hashlib.md5(b"10abc").digest()
+    )
+
+
+def test_key_separator():
+    first = {"_id": "1", "_source": {"a": "ab", "b": "c"}}
+    second = {"_id": "2", "_source": {"a": "a", "b": "bc"}}
+    builder = KeyBuilder(["a", "b"])
+    assert builder(first) != builder(second)
+    builder = KeyBuilder(["a", "b"], separator="")
+    assert builder(first) == builder(second)
+
+
+def test_key_hash():
+    hit = {"_id": "1", "_source": {"time": 10, "device": {"id": "abc"}}}
+    builder = KeyBuilder(["time"], hash="blake2b", key_size=8)
+    assert builder.key_size == 8
+    assert builder(hit) == hashlib.blake2b(b"10", digest_size=8).digest()
+    assert KeyBuilder(["time"], hash="blake2b")(hit) == (
+        hashlib.blake2b(b"10", digest_size=16).digest()
+    )
+
+    raw = KeyBuilder(["time", "device.id"], hash="none", key_size=8)
+    assert raw(hit) == b"\x0610\x1fabc\x00"
+    with pytest.raises(ValueError):
+        KeyBuilder(["device.id"], hash="none", key_size=3)(hit)
+
+    with pytest.raises(ValueError):
+        KeyBuilder(["time"], hash="md5", key_size=8)
+    with pytest.raises(ValueError):
+        KeyBuilder(["time"], hash="none")
+    with pytest.raises(ValueError):
+        KeyBuilder(["time"], hash="sha1")
+
+
+@pytest.mark.skipif(not xxhash_available(), reason="xxhash is not installed")
+def test_key_xxhash():
+    import xxhash
+
+    hit = {"_id": "1", "_source": {"time": 10}}
+    assert KeyBuilder(["time"], hash="xxhash", key_size=8)(hit) == (
+        xxhash.xxh3_64_digest(b"10")
+    )
+    assert KeyBuilder(["time"], hash="xxhash")(hit) == xxhash.xxh3_128_digest(b"10")
+
+
+def test_key_builder_docvalue():
+    hit = {"_id": "1", "fields": {"time": [10], "tags": ["a", "b"]}}
+    builder = KeyBuilder(["time", "tags[1]"], "docvalue")
+    assert builder.es_fields() == ["time", "tags"]
+    assert builder(hit) == hashlib.md5(b"10\x1fb").digest()
+    # multi-valued doc value as a whole
+    assert KeyBuilder(["tags"], "stored")(hit) == hashlib.md5(b"[a,b]").digest()
+    with pytest.raises(ValueError):
+        KeyBuilder(["time"], "fielddata")
@@ -0,0 +1,84 @@
+import hashlib
+
+import pytest
+
+from esdedupe.keystore import KeyCache, KeyStore
+
+
+def digest(s):
+    return hashlib.md5(s.encode("utf-8")).digest()
+
+
+def test_singletons_and_groups():
+    store = KeyStore(capacity=4)
+    assert store.add(digest("foo"), "a")
+    assert store.add(digest("bar"), "b")
+    assert not store.add(digest("foo"), "c")
+    assert not store.add(digest("foo"), "d")
+
+    assert len(store) == 2
+    assert store.docs == 4
+    assert store.duplicates == 2
+    assert store.get(digest("foo")) == ["a", "c", "d"]
+    assert store.get(digest("bar")) == ["b"]
+    assert store.get(digest("baz")) is None
+    assert digest("bar") in store
+    assert list(store.duplicate_groups()) == [(digest("foo"), ["a", "c", "d"])]
+
+
+def test_grow_keeps_groups():
+    store = KeyStore(capacity=1)
+    for i in range(5000):
+        store.add(digest(str(i % 1000)), "id-{}".format(i))
+
+    assert len(store) == 1000
+    assert store.duplicates == 4000
+    groups = dict(store.groups())
+    assert len(groups) == 1000
+    assert groups[digest("7")] == ["id-7", "id-1007", "id-2007", "id-3007", "id-4007"]
+
+
+def test_key_size():
+    store = KeyStore(key_size=8)
+    store.add(b"12345678", "x")
+    with pytest.raises(ValueError):
+        store.add(digest("foo"), "y")
+
+
+def test_keys_only():
+    store = KeyStore(capacity=1, ids=False)
+    for i in range(100):
+        assert store.add(digest(str(i)), "id-{}".format(i))
+    assert not store.add(digest("5"), "dupl")
+    assert len(store) == 100
+    assert store.docs == 101
+    assert store.duplicates == 1
+    with pytest.raises(RuntimeError):
+        list(store.duplicate_groups())
+
+
+def test_max_docs():
+    store = KeyStore()
+    store.MAX_DOCS = 3
+    for i in range(3):
+        store.add(digest(str(i % 2)), "id-{}".format(i))
+    with pytest.raises(OverflowError):
+        store.add(digest("2"), "id-3")
+    assert store.docs == 3
+    assert store.get(digest("0")) == ["id-0", "id-2"]
+
+
+def test_key_cache_lookback():
+    cache = KeyCache(lookback=100)
+    cache.start(0, 1000)
+    cache.remember(digest("early"), 500)
+    cache.remember(digest("late"), 950)
+    # keys of the current window aren't visible until the next one starts
+    assert digest("late") not in cache
+
+    cache.start(1000, 2000)
+    assert digest("late") in cache
+    # older than lookback before the window start
+    assert digest("early") not in cache
+    cache.start(2000, 3000)
+    assert len(cache) == 0
@@ -0,0 +1,91 @@
+import pytest
+import ujson
+
+from esdedupe import mapping
+from esdedupe.cli import ArgumentParser
+from esdedupe.esdedupe import Esdedupe
+from esdedupe.keystore import KeyCache, KeyStore
+from esdedupe.mapping import FORMATS, MappingWriter, detect_format, read_groups
+
+
+def test_read_groups(tmp_path, monkeypatch):
+    path = str(tmp_path / "mapping.json")
+    groups = {
+        "{:032x}".format(i): ["id-{}".format(j) for j in range(i % 4 + 1)]
+        for i in range(100)
+    }
+    with open(path, "w") as f:
+        f.write(ujson.dumps(groups, indent=2))
+    # values span multiple chunks
+    monkeypatch.setattr(mapping._ObjectReader, "CHUNK", 7)
+    assert list(read_groups(path)) == list(groups.items())
+
+
+def test_read_empty(tmp_path):
+    path = str(tmp_path / "mapping.json")
+    with open(path, "w") as f:
+        f.write("{}")
+    assert list(read_groups(path)) == []
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+@pytest.mark.parametrize("name", ["mapping", "mapping.gz"])
+def test_write_read(tmp_path, monkeypatch, fmt, name):
+    path = str(tmp_path / name)
+    groups = [
+        (bytes([i]) * 16, ["id-{}".format(j) for j in range(i % 4 + 2)])
+        for i in range(100)
+    ]
+    groups.append((b"\xff" * 16, ["ünicode", "x" * 300]))
+    with MappingWriter(path, fmt) as writer:
+        for key, ids in groups:
+            writer.write(key, ids)
+    assert writer.groups == 101
+
+    monkeypatch.setattr(mapping._BinaryReader, "CHUNK", 7)
+    assert detect_format(path) == fmt
+    assert list(read_groups(path)) == [(key.hex(), ids) for key, ids in groups]
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_write_empty(tmp_path, fmt):
+    path = str(tmp_path / "mapping")
+    MappingWriter(path, fmt).close()
+    assert list(read_groups(path)) == []
+
+
+def test_mapping_path():
+    dedupe = Esdedupe()
+    args = ArgumentParser().parse_args(["--log_dupl", "/tmp/docs.ndjson.gz"])
+    window = "2021-01-01T00:00:00.000Z/2021-01-01T01:00:00.000Z"
+    assert dedupe.mapping_path(args, "logs") == "/tmp/docs.ndjson.gz"
+    assert (
+        dedupe.mapping_path(args, "logs", window)
+        == "/tmp/docs.20210101T000000000Z.ndjson.gz"
+    )
+    args.all = True
+    assert (
+        dedupe.mapping_path(args, "logs-2021.01") == "/tmp/docs.logs-2021.01.ndjson.gz"
+    )
+    assert (
+        dedupe.mapping_path(args, "logs", window)
+        == "/tmp/docs.logs.20210101T000000000Z.ndjson.gz"
+    )
+
+
+def test_save_skips_carried_groups(tmp_path):
+    dedupe = Esdedupe()
+    args = ArgumentParser().parse_args(["--log_dupl", "docs.ndjson"])
+    store = KeyStore()
+    for key, doc_id in [(b"a", "1"), (b"a", "2"), (b"b", "3"), (b"b", "4")]:
+        store.add(key * 16, doc_id)
+    # key b was seen in previous window, both of its documents are deleted
+    cache = KeyCache(lookback=100)
+    cache.start(0, 1000)
+    cache.remember(b"b" * 16, 950)
+    cache.start(1000, 2000)
+    dedupe.caches["logs"] = cache
+
+    path = str(tmp_path / "docs.ndjson")
+    dedupe.save_documents_mapping(store, "logs", path, args)
+    assert list(read_groups(path)) == [((b"a" * 16).hex(), ["1", "2"])]
@@ -0,0 +1,34 @@
+from esdedupe.metrics import Metrics
+
+
+def test_prometheus():
+    metrics = Metrics()
+    metrics.inc("esdedupe_docs_scanned_total", 100)
+    metrics.inc("esdedupe_docs_scanned_total", 50)
+    metrics.observe("esdedupe_bulk_request_seconds", 0.02)
+    metrics.observe("esdedupe_bulk_request_seconds", 3)
+    with metrics.timed("scan"):
+        assert metrics.phase == "scan"
+    assert metrics.phase is None
+
+    text = metrics.prometheus()
+    assert "# TYPE esdedupe_docs_scanned_total counter" in text
+    assert "esdedupe_docs_scanned_total 150" in text
+    assert 'esdedupe_bulk_request_seconds_bucket{le="0.01"} 0' in text
+    assert 'esdedupe_bulk_request_seconds_bucket{le="0.025"} 1' in text
+    assert 'esdedupe_bulk_request_seconds_bucket{le="5"} 2' in text
+    assert 'esdedupe_bulk_request_seconds_bucket{le="+Inf"} 2' in text
+    assert "esdedupe_bulk_request_seconds_count 2" in text
+    assert 'esdedupe_phase_seconds_total{phase="scan"}' in text
+
+
+def test_snapshot():
+    metrics = Metrics()
+    metrics.inc("esdedupe_docs_deleted_total", 10)
+    metrics.inc("esdedupe_phase_seconds_total", 2, phase="delete")
+    snapshot = metrics.snapshot()
+    assert snapshot["deletes_per_sec"] == 5
+    assert snapshot["scan_docs_per_sec"] == 0
+    assert snapshot["metrics"]["esdedupe_docs_deleted_total"] == [
+        {"labels": {}, "value": 10}
+    ]
@@ -0,0 +1,84 @@
+import random
+import threading
+import time
+
+import ujson
+
+from esdedupe.cli import ArgumentParser
+from esdedupe.esdedupe import Esdedupe
+from esdedupe.keystore import KeyStore
+
+
+# mget responses take a random while, so that concurrent batches complete
+# out of order
+class MgetClient:
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def options(self, **kwargs):
+        return self
+
+    def mget(self, index, ids, **params):
+        with self.lock:
+            self.requests.append((ids, params))
+        time.sleep(random.random() * 0.01)
+        docs = [
+            {"_index": index, "_id": doc_id, "found": True, "_source": {"n": doc_id}}
+            for doc_id in ids
+        ]
+        return {"docs": docs}
+
+
+def store(*groups):
+    docs = KeyStore()
+    for n, ids in enumerate(groups):
+        for doc_id in ids:
+            docs.add(bytes([n]) * 16, doc_id)
+    return docs
+
+
+def test_doc_batches():
+    groups = [(b"\x01", ["a", "b"]), (b"\x02", ["c", "d", "e", "f"])]
+    batches = list(Esdedupe().doc_batches(iter(groups), 4))
+    # the second group spans two batches, only its first document is kept
+    assert batches == [
+        [("01", "a", True), ("01", "b", False), ("02", "c", True), ("02", "d", False)],
+        [("02", "e", False), ("02", "f", False)],
+    ]
+    assert list(Esdedupe().doc_batches(iter([]), 4)) == []
+
+
+def test_print_duplicates_order(tmp_path):
+    path = str(tmp_path / "docs.ndjson")
+    groups = [["id-{}-{}".format(g, i) for i in range(g % 5 + 1)] for g in range(40)]
+    docs = store(*groups)
+    es = MgetClient()
+    args = ArgumentParser().parse_args(
+        [
+            "-n",
+            "-b",
+            "3",
+            "--check-concurrency",
+            "4",
+            "--print-docs",
+            path,
+            "--print-fields",
+            "n",
+        ]
+    )
+    Esdedupe().print_duplicates(docs, "idx", es, args)
+
+    with open(path) as f:
+        lines = [ujson.loads(line) for line in f]
+    # groups are written in the order of mapping, regardless of which mget
+    # request completes first
+    expected = [
+        (key.hex(), doc_id, i == 0)
+        for key, ids in docs.duplicate_groups()
+        for i, doc_id in enumerate(ids)
+    ]
+    assert [(line["key"], line["_id"], line["keep"]) for line in lines] == expected
+    assert len(expected) == sum(len(ids) for ids in groups if len(ids) > 1)
+    assert all(len(ids) <= 3 for ids, params in es.requests)
+    assert all(params == {"source_includes": ["n"]} for ids, params in es.requests)
@@ -0,0 +1,22 @@
+from esdedupe.profiling import Profiler
+
+
+def test_phases(tmp_path):
+    profiler = Profiler(str(tmp_path / "profile"))
+    for _ in range(2):
+        with profiler.phase("scan"):
+            held = [bytearray(1024) for _ in range(100)]
+            # overlapping phase is not profiled
+            with profiler.phase("delete"):
+                pass
+    profiler.write()
+
+    assert sorted(profiler.phases) == ["scan"]
+    assert profiler.phases["scan"]["calls"] == 2
+    assert profiler.phases["scan"]["peak"] >= 100 * 1024
+    assert (tmp_path / "profile" / "scan.prof").exists()
+    report = (tmp_path / "profile" / "scan.txt").read_text()
+    assert report.startswith("phase: scan, runs: 2")
+    assert "CPU (top" in report
+    assert "bytearray(1024)" in report
+    assert held
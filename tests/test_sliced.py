@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+
+from esdedupe.cli import ArgumentParser
+from esdedupe.esdedupe import Esdedupe
+
+
+class SliceError(Exception):
+    pass
+
+
+# Every slice is scrolled in pages of `size` documents, `fail` maps slice ID
+# to the page whose request fails
+class SlicedClient:
+    def __init__(self, docs, fail=None):
+        self.docs = docs
+        self.fail = fail or {}
+        self.scrolls = {}
+        self.cleared = []
+        self.lock = threading.Lock()
+
+    def options(self, **kwargs):
+        return self
+
+    def search(self, index, scroll, size, slice, **kwargs):
+        ids = [
+            "doc-{}".format(i)
+            for i in range(self.docs)
+            if i % slice["max"] == slice["id"]
+        ]
+        scroll_id = "scroll-{}".format(slice["id"])
+        with self.lock:
+            self.scrolls[scroll_id] = [slice["id"], ids, 0, size]
+        return self.page(scroll_id)
+
+    def scroll(self, scroll_id, scroll):
+        return self.page(scroll_id)
+
+    def page(self, scroll_id):
+        with self.lock:
+            state = self.scrolls[scroll_id]
+            slice_id, ids, page, size = state
+            state[2] += 1
+        if self.fail.get(slice_id) == page:
+            raise SliceError("slice {} failed".format(slice_id))
+        hits = [{"_id": i} for i in ids[page * size : (page + 1) * size]]
+        return {
+            "_scroll_id": scroll_id,
+            "_shards": {"total": 1, "successful": 1},
+            "hits": {"hits": hits},
+        }
+
+    def clear_scroll(self, scroll_id):
+        with self.lock:
+            self.cleared.append(scroll_id)
+
+
+def parse(*argv):
+    return ArgumentParser().parse_args(["-b", "10"] + list(argv))
+
+
+def slice_workers():
+    return [t for t in threading.enumerate() if t.name.startswith("slice-")]
+
+
+def test_pages_of_all_slices():
+    es = SlicedClient(1000)
+    pages = Esdedupe().sliced_pages(es, "idx", {}, parse("--scan-slices", "3"))
+    ids = [hit["_id"] for page in pages for hit in page]
+    assert sorted(ids) == sorted("doc-{}".format(i) for i in range(1000))
+    assert sorted(es.cleared) == ["scroll-0", "scroll-1", "scroll-2"]
+    assert slice_workers() == []
+
+
+def test_failed_slice():
+    # slice 1 fails on its third page, the others are still being read
+    es = SlicedClient(10000, fail={1: 2})
+    pages = Esdedupe().sliced_pages(es, "idx", {}, parse("--scan-slices", "3"))
+    with pytest.raises(SliceError):
+        for page in pages:
+            pass
+    # workers are stopped and every scroll context is cleared
+    assert slice_workers() == []
+    assert sorted(es.cleared) == ["scroll-0", "scroll-1", "scroll-2"]
+
+
+def test_abandoned_scan():
+    es = SlicedClient(10000)
+    pages = Esdedupe().sliced_pages(es, "idx", {}, parse("--scan-slices", "2"))
+    next(pages)
+    pages.close()
+    assert slice_workers() == []
+    assert sorted(es.cleared) == ["scroll-0", "scroll-1"]
@@ -0,0 +1,118 @@
+from esdedupe.checkpoint import Checkpoint
+from esdedupe.cli import ArgumentParser
+from esdedupe.esdedupe import Esdedupe
+from esdedupe.fields import KeyBuilder
+
+FIELD = "Uuid.keyword"
+
+
+# Point in time search over documents sorted by key, `_shard_doc` tiebreaker
+# is the position of the document in the index
+class SortedClient:
+    def __init__(self, keys):
+        self.docs = [(key, "{}{}".format(key, i)) for i, key in enumerate(keys)]
+        self.deleted = set()
+        self.searches = []
+        self.closed = []
+
+    def options(self, **kwargs):
+        return self
+
+    def open_point_in_time(self, index, keep_alive):
+        return {"id": "pit-1"}
+
+    def close_point_in_time(self, id):
+        self.closed.append(id)
+
+    def search(self, size, pit, sort, search_after=None, **kwargs):
+        assert sort == [{FIELD: "asc"}, {"_shard_doc": "asc"}]
+        self.searches.append(search_after)
+        rows = sorted(
+            (key, n, doc_id)
+            for n, (key, doc_id) in enumerate(self.docs)
+            if doc_id not in self.deleted
+        )
+        if search_after is not None:
+            rows = [row for row in rows if list(row[:2]) > search_after]
+        hits = [
+            {
+                "_index": "idx",
+                "_id": doc_id,
+                "fields": {FIELD: [key]},
+                "sort": [key, n],
+            }
+            for key, n, doc_id in rows[:size]
+        ]
+        return {"pit_id": pit["id"], "hits": {"hits": hits}}
+
+
+def parse(*argv):
+    return ArgumentParser().parse_args(
+        ["--engine", "sorted", "-f", FIELD, "-b", "2"] + list(argv)
+    )
+
+
+def deleted(dedupe, es, args, position=None):
+    stats = {"docs": 0, "duplicates": 0}
+    pk = KeyBuilder([FIELD], "docvalue")
+    actions = dedupe.sorted_delete_iterator(es, pk, "idx", args, stats, position)
+    return [action["_id"] for action in actions], stats
+
+
+def test_duplicates_across_pages():
+    # pages: [a0, a1], [b2, b3], [b4, c5]
+    es = SortedClient(["a", "a", "b", "b", "b", "c"])
+    ids, stats = deleted(Esdedupe(), es, parse())
+    assert ids == ["a1", "b3", "b4"]
+    assert stats == {"docs": 6, "duplicates": 3, "sort": ["c", 5]}
+    assert es.searches == [None, ["a", 1], ["b", 3], ["c", 5]]
+    assert es.closed == ["pit-1"]
+
+
+def test_resume_within_group():
+    es = SortedClient(["a", "a", "b", "b", "b", "c"])
+    # a1 and b3 were deleted before the run got interrupted
+    es.deleted = {"a1", "b3"}
+    position = {"search_after": ["b", 3], "removed": 2}
+    ids, stats = deleted(Esdedupe(), es, parse(), position)
+    # group b is read again from its beginning, b2 is still kept
+    assert es.searches[0] == ["b", -1]
+    assert ids == ["b4"]
+    assert stats["docs"] == 3
+
+
+def test_checkpointed_delete(tmp_path, monkeypatch):
+    dedupe = Esdedupe()
+    dedupe.checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), FIELD)
+    es = SortedClient(["a", "a", "b", "b", "b", "c"])
+    args = parse("--checkpoint-interval", "2")
+    batches = []
+    positions = []
+    bars = []
+
+    def bulk_delete(actions, es, args, total=None, progress=None):
+        batches.append([action["_id"] for action in actions])
+        bars.append(progress)
+        return len(batches[-1])
+
+    def advance(index, window, position):
+        positions.append(position)
+
+    monkeypatch.setattr(dedupe, "bulk_delete", bulk_delete)
+    monkeypatch.setattr(dedupe.checkpoint, "advance", advance)
+    stats = {"docs": 0, "duplicates": 0}
+    pk = KeyBuilder([FIELD], "docvalue")
+    actions = dedupe.sorted_delete_iterator(es, pk, "idx", args, stats)
+    previous = {"search_after": ["a", 0], "removed": 10}
+    removed = dedupe.checkpointed_delete(
+        actions, es, "idx", None, previous, stats, args
+    )
+    assert batches == [["a1", "b3"], ["b4"]]
+    # position of the last acknowledged delete, removed includes previous runs
+    assert positions == [
+        {"search_after": ["b", 3], "removed": 12},
+        {"search_after": ["c", 5], "removed": 13},
+    ]
+    assert removed == 13
+    # all batches share one progress bar
+    assert bars[0] is not None and bars[0] is bars[1]
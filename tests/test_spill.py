@@ -0,0 +1,55 @@
+import hashlib
+
+from esdedupe.keystore import KeyStore
+from esdedupe.spill import SpillStore
+
+
+def digest(s):
+    return hashlib.md5(s.encode("utf-8")).digest()
+
+
+def test_spill_matches_keystore(tmp_path):
+    # budget small enough to create many runs
+    spill = SpillStore(4096, directory=str(tmp_path))
+    store = KeyStore()
+    for i in range(3000):
+        key = digest(str(i % 700))
+        spill.add(key, "id-{}".format(i))
+        store.add(key, "id-{}".format(i))
+
+    assert spill.spilled() > 0
+    assert len(spill) == len(store) == 700
+    assert spill.duplicates == store.duplicates == 2300
+    assert spill.docs == 3000
+    assert dict(spill.duplicate_groups()) == dict(store.duplicate_groups())
+
+    spill.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_multi_level_merge(tmp_path, monkeypatch):
+    monkeypatch.setattr(SpillStore, "MAX_FAN_IN", 3)
+    spill = SpillStore(1024, directory=str(tmp_path))
+    store = KeyStore()
+    for i in range(500):
+        key = digest(str(i % 120))
+        spill.add(key, "id-{}".format(i))
+        store.add(key, "id-{}".format(i))
+
+    assert len(spill) == len(store) == 120
+    # merged into fewer runs than the final merge may open
+    assert len(spill._runs) < 3
+    assert len(list(tmp_path.glob("*/run-*"))) == len(spill._runs)
+    # order of documents within groups is kept
+    assert dict(spill.duplicate_groups()) == dict(store.duplicate_groups())
+    spill.close()
+
+
+def test_in_memory_only(tmp_path):
+    spill = SpillStore(1024 * 1024, directory=str(tmp_path))
+    spill.add(digest("a"), "1")
+    spill.add(digest("b"), "2")
+    spill.add(digest("a"), "3")
+    assert spill.spilled() == 0
+    assert list(spill.duplicate_groups()) == [(digest("a"), ["1", "3"])]
+    spill.close()
@@ -0,0 +1,86 @@
+from datetime import datetime, timezone
+
+from esdedupe.cli import ArgumentParser
+from esdedupe.esdedupe import Esdedupe
+
+
+# date_histogram response from (ISO date, doc_count) buckets
+class HistogramClient:
+    def __init__(self, buckets):
+        self.buckets = [
+            {"key": int(millis(key)), "doc_count": count} for key, count in buckets
+        ]
+        self.aggs = None
+
+    def options(self, **kwargs):
+        return self
+
+    def search(self, index, size, aggs, **kwargs):
+        self.aggs = aggs
+        return {"aggregations": {"histogram": {"buckets": self.buckets}}}
+
+
+def millis(date):
+    return datetime.fromisoformat(date).replace(tzinfo=timezone.utc).timestamp() * 1000
+
+
+def date(s):
+    return datetime.fromisoformat(s)
+
+
+def windows(buckets, window_docs=100):
+    args = ArgumentParser().parse_args(
+        [
+            "-T",
+            "timestamp",
+            "-F",
+            "2021-01-01T00:00:30",
+            "-U",
+            "2021-01-01T01:00:00",
+            "-w",
+            "auto",
+            "--window-docs",
+            str(window_docs),
+        ]
+    )
+    es = HistogramClient(buckets)
+    return list(Esdedupe().auto_windows(es, "idx", args)), es
+
+
+def test_bucket_before_since():
+    # 1h is split into 10,000 buckets of 1s at most, bucket keys are rounded
+    # down, the first one might start before --since
+    result, es = windows(
+        [
+            ("2021-01-01T00:00:00", 60),
+            ("2021-01-01T00:01:00", 60),
+            ("2021-01-01T00:02:00", 30),
+        ]
+    )
+    assert es.aggs["histogram"]["date_histogram"]["fixed_interval"] == "1s"
+    assert result == [
+        (date("2021-01-01T00:00:30"), date("2021-01-01T00:01:00")),
+        (date("2021-01-01T00:01:00"), date("2021-01-01T01:00:00")),
+    ]
+
+
+def test_bucket_larger_than_window():
+    result, _ = windows(
+        [
+            ("2021-01-01T00:10:00", 10),
+            ("2021-01-01T00:20:00", 1000),
+            ("2021-01-01T00:30:00", 10),
+            ("2021-01-01T00:40:00", 10),
+        ]
+    )
+    # the large bucket forms a window on its own
+    assert result == [
+        (date("2021-01-01T00:00:30"), date("2021-01-01T00:20:00")),
+        (date("2021-01-01T00:20:00"), date("2021-01-01T00:30:00")),
+        (date("2021-01-01T00:30:00"), date("2021-01-01T01:00:00")),
+    ]
+
+
+def test_empty_histogram():
+    result, _ = windows([])
+    assert result == [(date("2021-01-01T00:00:30"), date("2021-01-01T01:00:00"))]